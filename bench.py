@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import json
+import logging
+import marshal
+import os
+import platform
+import random
+import re
+import sys
+import sysconfig
+import time
+import tracemalloc
+import types
+import zipfile
+
+import gencorpus
+import hybridloader
+import opcodemap
+import patchzip
+import tea
+import unmarshaller
+import unpacker
+import validate
+
+if sys.version_info[0] < 3:
+    raise Exception("This module is Python 3 only")
+
+logger = logging.getLogger(__name__)
+
+# Every benchmark is a function that returns a tuple of a callable running a
+# single iteration, the number of bytes and the number of operations that one
+# iteration processes. They are registered in this list in order. The callable
+# returns what it built such that the memory it retains can be told apart from
+# the temporary allocations.
+BENCHMARKS = []
+
+# minimum wall clock time a single timing run should take
+MIN_RUN_TIME = 0.2
+
+
+def benchmark(name):
+    def decorator(fn):
+        BENCHMARKS.append((name, fn))
+        return fn
+    return decorator
+
+
+def _sample_module():
+    # a reasonably sized module with plenty of nested code objects and only
+    # constant types the Marshaller can write back
+    with open(os.path.join(sysconfig.get_paths()["stdlib"], "argparse.py"),
+              "rb") as fd:
+        return compile(fd.read(), "argparse.py", "exec", dont_inherit=True,
+                       optimize=2)
+
+
+def _unmarshal(data):
+    um = unmarshaller.Unmarshaller(io.BytesIO(data).read)
+    return um.load()
+
+
+@benchmark("keyderiv")
+def bench_keyderiv():
+    def run():
+        return [unpacker.derive_key(i, 0x1000 + i) for i in range(16)]
+    return run, 0, 16
+
+
+def _bench_xxtea(size):
+    rnd = random.Random(size)
+    words = [rnd.getrandbits(32) for _ in range(size // 4)]
+    key = [rnd.getrandbits(32) for _ in range(4)]
+
+    def run():
+        return tea.tea_decipher(words, key)
+    return run, size, 1
+
+
+for _size in (64, 1024, 16384):
+    benchmark("xxtea/%d" % _size)(lambda size=_size: _bench_xxtea(size))
+
+
+UNMARSHAL_TYPES = {
+    "int": lambda: tuple(range(100000, 100200)),
+    "long": lambda: tuple(1 << (64 + i) for i in range(200)),
+    "float": lambda: tuple(i + 0.5 for i in range(200)),
+    "str": lambda: tuple("string_%d" % i for i in range(200)),
+    "unicode": lambda: tuple("ünicode_%d" % i for i in range(200)),
+    "bytes": lambda: tuple(b"%064d" % i for i in range(200)),
+    "tuple": lambda: tuple((i, i + 1) for i in range(200)),
+    "set": lambda: tuple(set(range(i, i + 8)) for i in range(200)),
+    "frozenset": lambda: tuple(frozenset(range(i, i + 8)) for i in range(200)),
+    "code": lambda: _sample_module(),
+}
+
+
+def _bench_unmarshal(kind):
+    obj = UNMARSHAL_TYPES[kind]()
+    data = marshal.dumps(obj)
+    nops = len(obj) if isinstance(obj, tuple) else 1
+
+    def run():
+        return _unmarshal(data)
+    return run, len(data), nops
+
+
+for _kind in UNMARSHAL_TYPES:
+    benchmark("unmarshal/%s" % _kind)(
+        lambda kind=_kind: _bench_unmarshal(kind))
+
+
+def _bench_bigint(bits):
+    obj = tuple((1 << bits) - 1 - i for i in range(16))
+    data = marshal.dumps(obj)
+
+    def run():
+        return _unmarshal(data)
+    return run, len(data), len(obj)
+
+
+for _bits in (64, 256, 2048, 16384):
+    benchmark("unmarshal/bigint/%d" % _bits)(
+        lambda bits=_bits: _bench_bigint(bits))
+
+
+def _permuted_mapping():
+    # a sanitized mapping for a random opcode permutation, like the ones
+    # gencorpus writes
+    opc_map = opcodemap.OpcodeMapping(None)
+    rnd = random.Random(0)
+    perm = gencorpus.random_permutation(rnd)
+    for x in range(256):
+        opc_map.map[perm[x]] = {x: 1}
+    opc_map.sanitize()
+    return opc_map, perm
+
+
+@benchmark("remap/code_bytes")
+def bench_remap_code_bytes():
+    opc_map, _ = _permuted_mapping()
+    bcode = bytes(random.Random(1).getrandbits(8) for _ in range(4096))
+
+    def run():
+        return unpacker.remap_code_bytes(bcode, opc_map)
+    return run, len(bcode), 1
+
+
+@benchmark("remap/code_object")
+def bench_remap_code_object():
+    opc_map, _ = _permuted_mapping()
+    co = _sample_module()
+
+    def run():
+        return unpacker.remap_code_object(co, opc_map)
+    return run, len(marshal.dumps(co)), 1
+
+
+@benchmark("marshal/reencrypt")
+def bench_reencrypt():
+    co = _sample_module()
+    rnd = random.Random(2)
+
+    def run():
+        return gencorpus.dump_pyc(co, rnd, 0, 0)
+    return run, len(marshal.dumps(co)), 1
+
+
+# the members and opcode mapping shared by the end-to-end benchmarks
+_loaded_zip = []
+
+
+def _load_zip(ns):
+    if not _loaded_zip:
+        _loaded_zip.append(_read_zip(ns))
+    return _loaded_zip[0]
+
+
+def _read_zip(ns):
+    # returns the members and the opcode mapping for the end-to-end
+    # benchmarks; without a zip a small synthetic corpus is generated
+    if ns.dropbox_zip:
+        db = ns.db or "opcode.db"
+        if not os.path.exists(db):
+            raise Exception("opcode db %s doesn't exist" % db)
+        with opcodemap.OpcodeMapping(db) as opc_map:
+            pass
+        with zipfile.PyZipFile(ns.dropbox_zip, "r") as zf:
+            fns = [x for x in zf.namelist() if x[-3:] == "pyc"]
+            members = [zf.read(x) for x in fns[:ns.zip_limit]]
+        return members, opc_map
+
+    opc_map, perm = _permuted_mapping()
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zout:
+        gencorpus.generate_corpus(sysconfig.get_paths()["stdlib"], zout,
+                                  perm, random.Random(3),
+                                  max_files=ns.zip_limit or 20)
+    with zipfile.ZipFile(buf, "r") as zf:
+        members = [zf.read(x) for x in zf.namelist()]
+    return members, opc_map
+
+
+def _bench_e2e(ns, fn):
+    members, opc_map = _load_zip(ns)
+
+    def run():
+        return [fn(data, opc_map) for data in members]
+    return run, sum(len(x) for x in members), len(members)
+
+
+def _bench_largest_consts(ns):
+    # the largest constant table in the zip, without the nested code objects
+    # such that only the container decoding is measured
+    members, _ = _load_zip(ns)
+    consts = ()
+    for data in members:
+        for co in validate._walk(hybridloader.load_pyc(data)):
+            if len(co.co_consts) > len(consts):
+                consts = co.co_consts
+    consts = tuple(x for x in consts if not isinstance(x, types.CodeType))
+    data = marshal.dumps(consts)
+
+    def run():
+        return _unmarshal(data)
+    return run, len(data), len(consts)
+
+
+def _e2e_unmarshaller(data, opc_map):
+    um = unmarshaller.Unmarshaller(io.BytesIO(data[16:]).read)
+    um.code_transform = unpacker.code_remapper(opc_map)
+    um.dispatch[unmarshaller.TYPE_CODE] = (unpacker.load_code, "TYPE_CODE")
+    return um.load()
+
+
+def _e2e_hybrid(data, opc_map):
+    return hybridloader.load_pyc(data, opc_map)
+
+
+def _e2e_patchzip(data, opc_map):
+    um = unmarshaller.Unmarshaller(io.BytesIO(data[16:]).read)
+    um.consts_transform = patchzip.replace_hash("", "")
+    um.dispatch[unmarshaller.TYPE_CODE] = (patchzip.load_code, "TYPE_CODE")
+    return um.load()
+
+
+E2E_BENCHMARKS = [
+    ("e2e/unmarshaller", _e2e_unmarshaller),
+    ("e2e/hybrid", _e2e_hybrid),
+    ("e2e/patchzip", _e2e_patchzip),
+]
+
+
+def run_benchmark(setup, repeat):
+    fn, nbytes, nops = setup()
+
+    # calibrate the number of iterations such that a run takes long enough
+    # to be measured reliably
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_RUN_TIME or loops >= 1 << 20:
+            break
+        loops *= 2
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        best = min(best, time.perf_counter() - start)
+
+    # the memory still in use after an iteration is what its result holds
+    # on to, everything above that up to the peak was temporary
+    tracemalloc.start()
+    retval = fn()
+    retained, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    del retval
+    allocs = sum(x.count for x in snapshot.statistics("filename"))
+
+    per_iter = best / loops
+    result = {
+        "ns_per_op": per_iter * 1e9 / nops,
+        "peak_kb": peak / 1024.0,
+        "retained_kb": retained / 1024.0,
+        "allocs": allocs,
+    }
+    if nbytes:
+        result["mb_per_s"] = nbytes / per_iter / 1e6
+    return result
+
+
+# the result fields compared against the baseline and their units
+COMPARED = (("ns_per_op", "ns/op"), ("peak_kb", "KB peak"),
+            ("allocs", "allocs"))
+
+
+def compare(results, baseline, max_regression):
+    failed = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for key, unit in COMPARED:
+            # older baselines don't have all of the fields
+            if key not in base:
+                continue
+            if base[key]:
+                change = (result[key] / base[key] - 1) * 100
+            else:
+                change = 100.0 if result[key] else 0.0
+            flag = ""
+            if change > max_regression:
+                flag = "  REGRESSION"
+                failed.append("%s (%s)" % (name, unit))
+            print("%-24s %12.1f -> %12.1f %-7s %+7.1f%%%s" %
+                  (name, base[key], result[key], unit, change, flag))
+    return failed
+
+
+if __name__ == "__main__":
+
+    root = logging.getLogger()
+    root.setLevel(logging.WARNING)
+    handler = logging.StreamHandler(sys.stdout)
+    formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    root.addHandler(handler)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--filter",
+                        help="only run benchmarks matching this regex")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of timing runs per benchmark")
+    parser.add_argument("--dropbox-zip",
+                        help="zip for the end-to-end benchmarks (a small "
+                             "synthetic corpus is used if not given)")
+    parser.add_argument("--db",
+                        help="opcode database for --dropbox-zip")
+    parser.add_argument("--zip-limit", type=int,
+                        help="only use the first N pyc files of the zip")
+    parser.add_argument("--output", default="bench.json",
+                        help="file to write the results to as JSON")
+    parser.add_argument("--baseline",
+                        help="baseline JSON file to compare the results to")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="also write the results to --baseline")
+    parser.add_argument("--max-regression", type=float, default=10.0,
+                        help="fail when the time, peak memory or number of "
+                             "allocations of a benchmark is this many "
+                             "percent above the baseline")
+    ns = parser.parse_args()
+
+    benchmarks = list(BENCHMARKS)
+    benchmarks.append(("unmarshal/largest_consts",
+                       lambda: _bench_largest_consts(ns)))
+    for name, fn in E2E_BENCHMARKS:
+        benchmarks.append((name, lambda fn=fn: _bench_e2e(ns, fn)))
+    if ns.filter:
+        benchmarks = [x for x in benchmarks if re.search(ns.filter, x[0])]
+
+    results = {}
+    for name, setup in benchmarks:
+        result = run_benchmark(setup, ns.repeat)
+        results[name] = result
+        print("%-24s %12.1f ns/op %10s MB/s %10.1f KB peak %10.1f KB "
+              "retained %8d allocs" %
+              (name, result["ns_per_op"],
+               "%.2f" % result["mb_per_s"] if "mb_per_s" in result else "-",
+               result["peak_kb"], result["retained_kb"], result["allocs"]))
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "time": time.time(),
+        "results": results,
+    }
+    with open(ns.output, "w") as fd:
+        json.dump(report, fd, indent=2, sort_keys=True)
+
+    failed = []
+    if ns.baseline and ns.save_baseline:
+        with open(ns.baseline, "w") as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+    elif ns.baseline:
+        with open(ns.baseline, "r") as fd:
+            baseline = json.load(fd)["results"]
+        print("")
+        failed = compare(results, baseline, ns.max_regression)
+    if failed:
+        print("%d benchmark(s) regressed more than %.1f%%: %s" %
+              (len(failed), ns.max_regression, ", ".join(failed)))
+        sys.exit(1)
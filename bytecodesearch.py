@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import dis
+import json
+import logging
+import os
+import re
+import sys
+import time
+import types
+
+import membercache
+import mmapzip
+import opcodemap
+import unpacker
+
+if sys.version_info[0] < 3:
+    raise Exception("This module is Python 3 only")
+
+logger = logging.getLogger(__name__)
+
+# Finds instruction sequences in the remapped bytecode of the zip. Every code
+# object is rendered as text with one "LINE OPNAME ARG" line per instruction
+# and a pattern like
+#
+#   LOAD_ATTR verify; ...; CALL_FUNCTION
+#
+# is compiled into a single regular expression over that text. A pattern is a
+# list of instructions separated by semicolons, each an opcode name and
+# optionally its argument, both of which can contain * and ? wildcards (the
+# argument is the name for the name and attribute opcodes and the repr for
+# LOAD_CONST). "..." matches any number of instructions. The rendered text of
+# the whole zip can be kept in an index file such that later searches don't
+# have to decrypt and remap anything; it records the translation table of the
+# opcode map it was rendered with and is rendered again if that changes.
+
+GAP = r"(?:[^\n]*\n)*?"
+
+
+def _glob(pattern, chars):
+    return "".join(chars + "*" if x == "*" else chars if x == "?" else
+                   re.escape(x) for x in pattern)
+
+
+def compile_pattern(pattern):
+    parts = []
+    for elem in pattern.split(";"):
+        elem = elem.strip()
+        if not elem:
+            raise Exception("empty instruction in pattern %r" % pattern)
+        if elem == "...":
+            parts.append(GAP)
+            continue
+        op, _, arg = elem.partition(" ")
+        arg = arg.strip()
+        parts.append(r"\d+ %s %s\n" % (_glob(op.upper(), "[A-Z_]"),
+                                       _glob(arg, r"[^\n]") if arg
+                                       else r"[^\n]*"))
+    if all(x == GAP for x in parts):
+        raise Exception("pattern %r matches everything" % pattern)
+    return re.compile("^" + "".join(parts), re.MULTILINE)
+
+
+def instruction_text(co):
+    lines = []
+    line = co.co_firstlineno
+    for instr in dis.get_instructions(co):
+        if instr.starts_line is not None:
+            line = instr.starts_line
+        arg = instr.argrepr
+        if not arg and instr.arg is not None:
+            arg = str(instr.arg)
+        # without the addresses of the code objects to keep the index the
+        # same from run to run
+        arg = re.sub(r" at 0x[0-9a-f]+", "", arg)
+        lines.append("%d %s %s\n" % (line, instr.opname, arg))
+    return "".join(lines)
+
+
+def code_texts(co):
+    # (dotted path, instruction text) of co and every code object nested in it
+    texts = []
+    todo = [(co, co.co_name)]
+    while todo:
+        co, path = todo.pop()
+        texts.append((path, instruction_text(co)))
+        prefix = "" if co.co_name == "<module>" else path + "."
+        todo.extend((x, prefix + x.co_name) for x in co.co_consts
+                    if isinstance(x, types.CodeType))
+    return texts
+
+
+def build_index(zf, opc_map, cache=None, index=None, module=None,
+                translation=None):
+    # pyc file -> {"crc": CRC of the member, "code": code_texts()}; entries of
+    # an existing index rendered with the same opcode translation table are
+    # reused for the members whose CRC didn't change
+    old = index or {}
+    if old and translation != opc_map.translation:
+        logger.info("the index was rendered with another opcode map, "
+                    "rendering all modules again")
+        old = {}
+    index = {}
+    start = time.perf_counter()
+    rendered = 0
+    for info in zf.infolist():
+        fn = info.filename
+        if fn[-3:] != "pyc" or (module is not None and not module.search(fn)):
+            continue
+        entry = old.get(fn)
+        if entry is None or entry["crc"] != info.CRC:
+            try:
+                co = unpacker.load_pyc(zf, fn, opc_map, cache)
+                entry = {"crc": info.CRC, "code": code_texts(co)}
+            except Exception as e:
+                logger.error("cannot load %s (%s), leaving it out" %
+                             (fn, str(e)))
+                continue
+            rendered += 1
+        index[fn] = entry
+    logger.info("rendered %d of %d modules in %.2fs" %
+                (rendered, len(index), time.perf_counter() - start))
+    return index, rendered
+
+
+def read_index(fn):
+    # returns the index and the translation table it was rendered with
+    with open(fn) as fd:
+        data = json.load(fd)
+    if "modules" not in data:
+        raise Exception("%s is not an index written by this version" % fn)
+    return data["modules"], bytes.fromhex(data["translation"])
+
+
+def write_index(index, translation, fn):
+    with open(fn, "w") as fd:
+        json.dump({"translation": translation.hex(), "modules": index}, fd,
+                  sort_keys=True)
+
+
+def search(index, matcher):
+    # yields (pyc file, dotted path, line, matched instructions) for every
+    # match of the compiled pattern
+    for fn in sorted(index):
+        for path, text in index[fn]["code"]:
+            for m in matcher.finditer(text):
+                found = m.group(0)
+                line, _, _ = found.partition(" ")
+                yield fn, path, int(line), found.rstrip("\n").split("\n")
+
+
+if __name__ == "__main__":
+
+    root = logging.getLogger()
+    root.setLevel(logging.WARNING)
+    logger.setLevel(logging.DEBUG)
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    root.addHandler(handler)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dropbox-zip",
+                        help="zipfile containing the dropbox obfuscated code "
+                             "(not needed if the index is up to date)")
+    parser.add_argument("--db", default="opcode.db",
+                        help="opcode database file to use")
+    parser.add_argument("--cache",
+                        help="member cache file with decrypted marshal "
+                             "streams (created if it doesn't exist)")
+    parser.add_argument("--index",
+                        help="index file with the instructions of every "
+                             "module (created or updated if the zip is given)")
+    parser.add_argument("--module",
+                        help="only search the members whose name matches "
+                             "this regex")
+    parser.add_argument("--show", action="store_true",
+                        help="print the matched instructions as well")
+    parser.add_argument("pattern", nargs="*",
+                        help="instruction pattern, e.g. "
+                             "'LOAD_ATTR verify; ...; CALL_FUNCTION'")
+    ns = parser.parse_args()
+
+    if not ns.dropbox_zip and not (ns.index and os.path.exists(ns.index)):
+        parser.error("either --dropbox-zip or an existing --index is needed")
+    matchers = [compile_pattern(x) for x in ns.pattern]
+    module = re.compile(ns.module) if ns.module else None
+
+    index = None
+    translation = None
+    if ns.index and os.path.exists(ns.index):
+        start = time.perf_counter()
+        try:
+            index, translation = read_index(ns.index)
+        except Exception as e:
+            if not ns.dropbox_zip:
+                raise
+            logger.warning("cannot read the index (%s), rendering it again" %
+                           str(e))
+            index = {}
+        logger.info("read the index of %d modules in %.2fs" %
+                    (len(index), time.perf_counter() - start))
+    if ns.dropbox_zip:
+        with contextlib.ExitStack() as stack:
+            opc_map = stack.enter_context(opcodemap.OpcodeMapping(ns.db,
+                                                                  False))
+            cache = None
+            if ns.cache:
+                cache = stack.enter_context(membercache.MemberCache(ns.cache))
+            zf = stack.enter_context(mmapzip.open_zipfile(ns.dropbox_zip))
+            # the index always covers the whole zip
+            old = index
+            index, rendered = build_index(zf, opc_map, cache, old,
+                                          None if ns.index else module,
+                                          translation)
+        if ns.index and (old is None or rendered or set(old) != set(index) or
+                         translation != opc_map.translation):
+            write_index(index, opc_map.translation, ns.index)
+    if module is not None:
+        index = dict((k, v) for k, v in index.items() if module.search(k))
+
+    for pattern, matcher in zip(ns.pattern, matchers):
+        start = time.perf_counter()
+        hits = 0
+        for fn, path, line, instrs in search(index, matcher):
+            hits += 1
+            print("%s:%s:%d" % (fn[:-1], path, line))
+            if ns.show:
+                for x in instrs:
+                    print("    " + x)
+        logger.info("%d hits for %s in %.2fs" %
+                    (hits, pattern, time.perf_counter() - start))
@@ -8,6 +8,9 @@ import opcodemap
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--db")
+    parser.add_argument("--convert",
+                        help="write the (possibly legacy) opcode db back out "
+                             "in the current binary format to this file")
     ns = parser.parse_args()
     if not ns.db:
         ns.db = "opcode.db"
@@ -23,6 +26,18 @@ if __name__ == "__main__":
         assert(opc_map.get(252) == 156)
         assert(table.get(156) == 252)
 
+        if ns.convert:
+            opc_map.write(ns.convert)
+            print("wrote %s in the current opcode db format" % ns.convert)
+
+        print("dropbox version: %s" % (opc_map.dropbox_version or "unknown"))
+        print("pyc magic: %s" % opc_map.pyc_magic.hex())
+        print("zip sha256: %s" % opc_map.zip_hash.hex())
+        print("evidence: %d opcode pairs seen in %d mapped members" %
+              (sum(sum(x.values()) for x in opc_map.map.values()),
+               len(opc_map.members)))
+        print("")
+
         print("mapping as defined in %s is as follows:" % ns.db)
         fmt = "| {0:<30} | {1:>7} | {2:>7} |"
         print(fmt.format("="*30, "="*7, "="*7))
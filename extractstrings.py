@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import dis
+import json
+import logging
+import multiprocessing
+import re
+import sys
+import time
+import types
+
+import membercache
+import mmapzip
+import opcodemap
+import unpacker
+
+if sys.version_info[0] < 3:
+    raise Exception("This module is Python 3 only")
+
+logger = logging.getLogger(__name__)
+
+# Streams the string and bytes constants of every code object in the zip as
+# lines of JSON. The members are only decrypted; the opcodes are not remapped
+# and nothing is decompiled. With an opcode map the line of the first
+# LOAD_CONST of every constant is looked up, otherwise the line of the code
+# object it is in is used.
+
+LOAD_CONST = dis.opmap["LOAD_CONST"]
+EXTENDED_ARG = dis.opmap["EXTENDED_ARG"]
+
+
+def _strings(x):
+    if isinstance(x, (str, bytes)):
+        yield x
+    elif isinstance(x, (tuple, frozenset)):
+        for y in x:
+            yield from _strings(y)
+
+
+def const_lines(co, table):
+    # maps the index of every constant loaded by co to the line of its first
+    # LOAD_CONST; the opcodes are translated on the fly with table
+    starts = dict(dis.findlinestarts(co))
+    lines = {}
+    line = co.co_firstlineno
+    code = co.co_code
+    arg = 0
+    for i in range(0, len(code), 2):
+        line = starts.get(i, line)
+        op = table[code[i]]
+        arg = arg | code[i+1]
+        if op == EXTENDED_ARG:
+            arg <<= 8
+            continue
+        if op == LOAD_CONST and arg not in lines:
+            lines[arg] = line
+        arg = 0
+    return lines
+
+
+def extract_strings(fn, co, table=None, match=None, min_length=1):
+    # yields a record for every string or bytes constant in co and the code
+    # objects nested in it
+    todo = [(co, co.co_name)]
+    while todo:
+        co, path = todo.pop()
+        lines = const_lines(co, table) if table is not None else {}
+        for i, x in enumerate(co.co_consts):
+            if isinstance(x, types.CodeType):
+                prefix = "" if co.co_name == "<module>" else path + "."
+                todo.append((x, prefix + x.co_name))
+                continue
+            for s in _strings(x):
+                if len(s) < min_length:
+                    continue
+                kind = "str"
+                if isinstance(s, bytes):
+                    kind = "bytes"
+                    s = s.decode("latin-1")
+                if match is not None and not match.search(s):
+                    continue
+                yield {"module": fn, "qualname": path,
+                       "line": lines.get(i, co.co_firstlineno),
+                       "type": kind, "value": s}
+
+
+# settings of the worker processes, set by _init_worker
+_worker = {}
+
+
+def _init_worker(zf, zipfn, table, cache, match, min_length):
+    # every worker process maps the zip itself rather than sharing the file
+    # offset of a zipfile opened before forking
+    if zf is None:
+        zf = mmapzip.open_zipfile(zipfn)
+    _worker["zf"] = zf
+    _worker["table"] = table
+    _worker["cache"] = cache
+    _worker["match"] = match
+    _worker["min_length"] = min_length
+
+
+def _extract_member(fn):
+    # returns the records and the decrypted member if it has to be added to
+    # the cache, which only the main process writes
+    zf = _worker["zf"]
+    cache = _worker["cache"]
+    new_data = None
+    try:
+        info = zf.getinfo(fn)
+        data = cache.get(info) if cache is not None else None
+        if data is None:
+            data = unpacker.decrypt_pyc(fn, zf.read(info))
+            if cache is not None:
+                new_data = data
+        co = unpacker.load_pyc_data(data)
+    except Exception as e:
+        logger.error("cannot load %s (%s), leaving it out" % (fn, str(e)))
+        return [], None
+    return list(extract_strings(fn, co, _worker["table"], _worker["match"],
+                                _worker["min_length"])), new_data
+
+
+if __name__ == "__main__":
+
+    root = logging.getLogger()
+    root.setLevel(logging.WARNING)
+    logger.setLevel(logging.DEBUG)
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    root.addHandler(handler)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dropbox-zip", required=True,
+                        help="zipfile containing the dropbox obfuscated code")
+    parser.add_argument("--db",
+                        help="opcode database file used to find the line "
+                             "numbers of the constants")
+    parser.add_argument("--cache",
+                        help="member cache file with decrypted marshal "
+                             "streams (created if it doesn't exist)")
+    parser.add_argument("--output", default="-",
+                        help="output file for the JSON lines (- for stdout)")
+    parser.add_argument("--match",
+                        help="only output the constants matching this regex")
+    parser.add_argument("--module",
+                        help="only look at the members whose name matches "
+                             "this regex")
+    parser.add_argument("--min-length", type=int, default=1,
+                        help="minimum length of the constants")
+    parser.add_argument("--jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="number of worker processes")
+    ns = parser.parse_args()
+
+    table = None
+    if ns.db:
+        with opcodemap.OpcodeMapping(ns.db, False) as opc_map:
+            table = opc_map.translation
+    match = re.compile(ns.match) if ns.match else None
+    module = re.compile(ns.module) if ns.module else None
+
+    with contextlib.ExitStack() as stack:
+        cache = None
+        if ns.cache:
+            cache = stack.enter_context(membercache.MemberCache(ns.cache))
+        zf = stack.enter_context(mmapzip.open_zipfile(ns.dropbox_zip))
+        fns = [x for x in zf.namelist() if x[-3:] == "pyc" and
+               (module is None or module.search(x))]
+        out = sys.stdout
+        if ns.output != "-":
+            out = stack.enter_context(open(ns.output, "w"))
+
+        start = time.perf_counter()
+        count = 0
+        args = (ns.dropbox_zip, table, cache, match, ns.min_length)
+        if ns.jobs > 1:
+            pool = stack.enter_context(multiprocessing.Pool(ns.jobs,
+                                                            _init_worker,
+                                                            (None,) + args))
+            results = pool.imap(_extract_member, fns, 4)
+        else:
+            _init_worker(zf, *args)
+            results = map(_extract_member, fns)
+        for fn, (records, new_data) in zip(fns, results):
+            if new_data is not None:
+                cache.put(zf.getinfo(fn), new_data)
+            for record in records:
+                out.write(json.dumps(record) + "\n")
+            count += len(records)
+        logger.info("extracted %d constants from %d modules in %.2fs" %
+                    (count, len(fns), time.perf_counter() - start))
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import platform
+import sys
+import types
+
+if sys.version_info[0] < 3:
+    raise Exception("This module is Python 3 only")
+
+logger = logging.getLogger(__name__)
+
+
+# Content hashes of code objects. The filename is never part of the hash so
+# identical modules at different paths in the zip (or in the stdlib) hash the
+# same. Constants are serialized through repr() which is stable for all
+# constant types except frozensets, whose iteration order depends on how
+# they were built, so those are sorted first.
+
+
+def _const_key(x, ignore_lines):
+    if isinstance(x, types.CodeType):
+        return "code:" + code_hash(x, ignore_lines)
+    if isinstance(x, tuple):
+        return "(%s)" % ",".join(_const_key(y, ignore_lines) for y in x)
+    if isinstance(x, frozenset):
+        return "frozenset(%s)" % ",".join(sorted(_const_key(y, ignore_lines)
+                                                 for y in x))
+    return "%s:%r" % (type(x).__name__, x)
+
+
+def code_hash(co, ignore_lines=False):
+    parts = (co.co_argcount, co.co_kwonlyargcount, co.co_nlocals,
+             co.co_stacksize, co.co_flags, co.co_code, co.co_names,
+             co.co_varnames, co.co_freevars, co.co_cellvars, co.co_name,
+             tuple(_const_key(x, ignore_lines) for x in co.co_consts))
+    if not ignore_lines:
+        parts += (co.co_firstlineno, co.co_lnotab)
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+
+def definition_hash(co):
+    # hash of a single function, class or module body without line numbers.
+    # Nested functions and classes are only represented by their names such
+    # that a change to one of them doesn't show up in the code around it;
+    # lambdas and comprehensions are part of the code they are in.
+    def key(x):
+        if not isinstance(x, types.CodeType):
+            return _const_key(x, True)
+        if x.co_name[:1] == "<":
+            return "code:" + definition_hash(x)
+        return "def:" + x.co_name
+    parts = (co.co_argcount, co.co_kwonlyargcount, co.co_flags, co.co_code,
+             co.co_names, co.co_varnames, co.co_freevars, co.co_cellvars,
+             co.co_name, tuple(key(x) for x in co.co_consts))
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+
+def find_sources(srcdir):
+    # the .py files below srcdir in a stable order, without site-packages
+    fns = []
+    for dirpath, dirnames, filenames in os.walk(srcdir):
+        dirnames[:] = sorted(x for x in dirnames
+                             if x not in ("site-packages", "__pycache__"))
+        for fn in sorted(filenames):
+            if fn[-3:] == ".py":
+                fns.append(os.path.join(dirpath, fn))
+    return fns
+
+
+class StdlibFingerprints:
+    # maps the line number independent hashes of the modules of a reference
+    # CPython Lib directory to their paths relative to that directory
+    def __init__(self, libdir=None, modules=None):
+        self.libdir = libdir
+        self.modules = modules or {}
+
+    @classmethod
+    def build(cls, libdir):
+        modules = {}
+        for pyfn in find_sources(libdir):
+            relfn = os.path.relpath(pyfn, libdir)
+            try:
+                with open(pyfn, "rb") as fd:
+                    co = compile(fd.read(), relfn, "exec", dont_inherit=True,
+                                 optimize=2)
+            except Exception:
+                logger.debug("cannot compile %s" % pyfn)
+                continue
+            modules.setdefault(code_hash(co, True), relfn)
+        return cls(os.path.abspath(libdir), modules)
+
+    @classmethod
+    def load(cls, fn):
+        with open(fn, "r") as fd:
+            data = json.load(fd)
+        return cls(data["lib"], data["modules"])
+
+    def write(self, fn):
+        with open(fn, "w") as fd:
+            json.dump({"lib": self.libdir, "python": platform.python_version(),
+                       "modules": self.modules}, fd, indent=1, sort_keys=True)
+
+    def lookup(self, co):
+        return self.modules.get(code_hash(co, True))
+
+
+if __name__ == "__main__":
+
+    root = logging.getLogger()
+    root.setLevel(logging.WARNING)
+    logger.setLevel(logging.DEBUG)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    root.addHandler(handler)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--python-dir", required=True,
+                        help="Python source dir (e.g. tmp/Python-3.7.4) whose "
+                             "Lib directory is fingerprinted")
+    parser.add_argument("--output", default="stdlib-fingerprints.json",
+                        help="output file for the fingerprints")
+    ns = parser.parse_args()
+
+    if sys.version_info[:2] != (3, 7):
+        logger.warning("the fingerprints have to be built with Python 3.7 to "
+                       "match the bytecode in the zip but this is Python "
+                       "%d.%d" % sys.version_info[:2])
+
+    fps = StdlibFingerprints.build(os.path.join(ns.python_dir, "Lib"))
+    fps.write(ns.output)
+    logger.info("wrote fingerprints of %d modules to %s" %
+                (len(fps.modules), ns.output))
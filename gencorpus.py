@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import argparse
+import dis
+import importlib.util
+import io
+import logging
+import os
+import random
+import struct
+import sys
+import sysconfig
+import time
+import types
+import zipfile
+
+import fingerprint
+import opcodemap
+import patchzip
+import unmarshaller
+
+if sys.version_info[0] < 3:
+    raise Exception("This module is Python 3 only")
+
+logger = logging.getLogger(__name__)
+
+
+def random_permutation(rnd):
+    # returns a Python opcode -> obfuscated opcode table; STORE_NAME (90) is
+    # never remapped by the unpacker so it is kept in place here too
+    perm = [x for x in range(256) if x != 90]
+    rnd.shuffle(perm)
+    perm.insert(90, 90)
+    return perm
+
+
+def permutation_from_db(fn):
+    with opcodemap.OpcodeMapping(fn, False) as opc_map:
+        if not opc_map.loaded_from_fs:
+            raise Exception("cannot load opcode db %s" % fn)
+        perm = list(range(256))
+        for dbx_op, py_op in opc_map.table.items():
+            perm[py_op] = dbx_op
+    if len(set(perm)) != 256:
+        logger.warning("opcode db %s doesn't describe a full permutation so "
+                       "some opcodes in the corpus will be ambiguous" % fn)
+    return perm
+
+
+def obfuscate_code_object(co, perm):
+    bcode = bytearray(co.co_code)
+    for i in range(0, len(bcode), 2):
+        bcode[i] = perm[bcode[i]]
+    consts = tuple(obfuscate_code_object(x, perm)
+                   if isinstance(x, types.CodeType) else x
+                   for x in co.co_consts)
+    return types.CodeType(co.co_argcount, co.co_kwonlyargcount,
+                          co.co_nlocals, co.co_stacksize, co.co_flags,
+                          bytes(bcode), consts, co.co_names,
+                          co.co_varnames, co.co_filename, co.co_name,
+                          co.co_firstlineno, co.co_lnotab,
+                          co.co_freevars, co.co_cellvars)
+
+
+def code_depth(co):
+    return 1 + max([code_depth(x) for x in co.co_consts
+                    if isinstance(x, types.CodeType)] + [0])
+
+
+def nested_source(depth):
+    # a chain of depth functions, each defined in and called by the previous
+    # one, to get code objects nested at least that deep in every module
+    lines = []
+    for i in range(depth):
+        lines.append("%sdef _nested_%d(x=%d):" % ("    " * i, i, i))
+    lines.append("%sreturn x" % ("    " * depth))
+    for i in range(depth - 1, 0, -1):
+        lines.append("%sreturn _nested_%d(x) + x" % ("    " * i, i))
+    return "\n".join(lines) + "\n"
+
+
+def dump_pyc(co, rnd, mtime, size):
+    with io.BytesIO() as out:
+        out.write(importlib.util.MAGIC_NUMBER)
+        out.write(struct.pack("<LLL", 0, mtime, size & 0xffffffff))
+        m = unmarshaller.Marshaller(out.write, out)
+        m.dispatch[unmarshaller.TYPE_CODE] = \
+            (lambda self, co: patchzip.dump_code_wrapper(self, co,
+                                                         rnd.getrandbits(32)),
+             "TYPE_CODE")
+        m.dump(co)
+        return out.getvalue()
+
+
+def generate_corpus(srcdir, zout, perm, rnd, max_files=None, max_size=None,
+                    max_depth=None, nest_depth=None):
+    written = 0
+    skipped = 0
+    total_size = 0
+    for pyfn in fingerprint.find_sources(srcdir):
+        if max_files is not None and written >= max_files:
+            break
+        relfn = os.path.relpath(pyfn, srcdir)
+        try:
+            with open(pyfn, "rb") as fd:
+                src = fd.read()
+            if nest_depth:
+                src = src + b"\n\n" + nested_source(nest_depth).encode()
+            co = compile(src, relfn, "exec", dont_inherit=True, optimize=2)
+        except Exception:
+            skipped += 1
+            continue
+        if max_depth is not None and code_depth(co) > max_depth:
+            skipped += 1
+            continue
+        try:
+            data = dump_pyc(obfuscate_code_object(co, perm), rnd,
+                            int(os.path.getmtime(pyfn)), len(src))
+        except NotImplementedError:
+            # the Marshaller doesn't implement every type, for example
+            # frozenset constants; just leave those modules out
+            logger.debug("cannot marshal %s" % relfn)
+            skipped += 1
+            continue
+        if max_size is not None and total_size + len(data) > max_size:
+            break
+        zout.writestr(relfn + "c", data)
+        written += 1
+        total_size += len(data)
+        logger.debug("added %s (%d bytes)" % (relfn, len(data)))
+    return written, skipped, total_size
+
+
+if __name__ == "__main__":
+
+    root = logging.getLogger()
+    root.setLevel(logging.WARNING)
+    logger.setLevel(logging.DEBUG)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    root.addHandler(handler)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source-dir",
+                        default=sysconfig.get_paths()["stdlib"],
+                        help="source tree to compile (defaults to the stdlib "
+                             "of the running interpreter)")
+    parser.add_argument("--output-zip", default="./corpus.zip",
+                        help="output zip in the python-packages format")
+    parser.add_argument("--db", default="./corpus.db",
+                        help="output opcode database matching the corpus")
+    parser.add_argument("--opcode-db",
+                        help="use the mapping from this opcode database "
+                             "instead of a random permutation")
+    parser.add_argument("--seed", type=int,
+                        help="seed for the opcode permutation and the "
+                             "per-code object rand values")
+    parser.add_argument("--max-files", type=int,
+                        help="maximum number of modules in the corpus")
+    parser.add_argument("--max-size", type=int,
+                        help="maximum total size in bytes of the pyc files")
+    parser.add_argument("--max-depth", type=int,
+                        help="skip modules with code objects nested deeper "
+                             "than this")
+    parser.add_argument("--nest-depth", type=int,
+                        help="append a chain of functions nested this deep "
+                             "to every module")
+    ns = parser.parse_args()
+
+    if sys.version_info[:2] != (3, 7):
+        logger.warning("the unpacker expects Python 3.7 bytecode but this is "
+                       "Python %d.%d" % sys.version_info[:2])
+
+    rnd = random.Random(ns.seed)
+    if ns.opcode_db:
+        perm = permutation_from_db(ns.opcode_db)
+    else:
+        perm = random_permutation(rnd)
+
+    start = time.time()
+    with zipfile.PyZipFile(ns.output_zip, "w", zipfile.ZIP_DEFLATED) as zout:
+        written, skipped, total_size = generate_corpus(ns.source_dir, zout,
+                                                       perm, rnd,
+                                                       ns.max_files,
+                                                       ns.max_size,
+                                                       ns.max_depth,
+                                                       ns.nest_depth)
+    logger.info("wrote %d modules (%d bytes of pyc files, %d skipped) to %s "
+                "in %.1fs" % (written, total_size, skipped, ns.output_zip,
+                              time.time() - start))
+
+    # feed the ground truth in as evidence such that sanitize() builds all
+    # of the tables
+    opc_map = opcodemap.OpcodeMapping(ns.db, True)
+    for x in range(256):
+        if dis.opname[x][0] != "<":
+            opc_map.map[perm[x]] = {x: 1}
+    opc_map.sanitize()
+    opc_map.dropbox_version = "synthetic"
+    opc_map.pyc_magic = importlib.util.MAGIC_NUMBER
+    opc_map.zip_hash = opcodemap.zip_sha256(ns.output_zip)
+    opc_map.write(ns.db)
+    logger.info("wrote the matching opcode database to %s" % ns.db)
@@ -1,67 +1,89 @@
 #!/usr/bin/env python3
 
 import argparse
+import contextlib
 import py_compile
 import logging
 import marshal
 import os
+import re
 import sys
 import zipfile
 
+import membercache
 import opcodemap
-import unmarshaller
 import unpacker
 
 logger = logging.getLogger(__name__)
 
 
-def generate_opcode_mapping_from_zipfile(opc_map, zf, pydir):
+def generate_opcode_mapping_from_zipfile(opc_map, zf, pydir, limit=None,
+                                         cache=None):
+    fns = [x for x in zf.namelist() if x[-3:] == "pyc"]
+    if not fns:
+        raise Exception("no pyc files in the zip")
+    with zf.open(fns[0], "r") as f:
+        pyc_magic = f.read(4)
+    if opc_map.map and opc_map.pyc_magic not in (bytes(4), pyc_magic):
+        # the evidence of a different Python version can't be merged
+        raise Exception("pyc magic %s of the zip differs from %s in the "
+                        "opcode db, use --fresh to start over" %
+                        (pyc_magic.hex(), opc_map.pyc_magic.hex()))
+    opc_map.pyc_magic = pyc_magic
+
     total = 0
     mapped = 0
-    for fn in zf.namelist():
-        if fn[-3:] != "pyc":
+    known = 0
+    for fn in fns:
+        info = zf.getinfo(fn)
+        if opc_map.has_member(info):
+            # its evidence is already in the db the run started from
+            known += 1
+            continue
+        if limit is not None and mapped >= limit:
+            break
+        # only decrypt what can actually be mapped
+        if not os.path.exists(os.path.join(pydir, fn[:-1])):
+            continue
+        remapped_co = unpacker.load_pyc(zf, fn, None, cache)
+
+        total += 1
+
+        # bytecompile the .py file to a .pyc file
+        pyfn = os.path.join(pydir, fn[:-1])
+        optimize = 2  # level is -OO
+        try:
+            py_compile.compile(pyfn, cfile=None, dfile=None, doraise=True,
+                               optimize=optimize)
+            logger.debug("succesfully compiled %s" % pyfn)
+        except Exception:
+            continue
+
+        # load the resulting .pyc file and compare it to the dropbox one
+        try:
+            libfile = os.path.join(pydir, "%s.cpython-37.opt-2.pyc" %
+                                   (fn[:-4]))
+            libfile = os.path.join(os.path.dirname(libfile),
+                                   "__pycache__",
+                                   os.path.basename(libfile))
+            with open(libfile, "rb") as f:
+                f.read(16)
+                data = f.read()
+                orig_co = marshal.loads(data)
+                logger.info("mapping %s to %s" % (remapped_co.co_filename,
+                            libfile))
+                opc_map.map_co_objects(remapped_co, orig_co)
+
+            opc_map.add_member(info)
+            mapped += 1
+        except FileNotFoundError:
             continue
-        with zf.open(fn, "r") as f:
-
-            data = f.read(16)
-            ulc = unpacker.load_code_without_patching
-            um = unmarshaller.Unmarshaller(f.read)
-            um.dispatch[unmarshaller.TYPE_CODE] = (ulc, "TYPE_CODE")
-            remapped_co = um.load()
-
-            total += 1
-
-            # bytecompile the .py file to a .pyc file
-            pyfn = os.path.join(pydir, fn[:-1])
-            optimize = 2  # level is -OO
-            try:
-                py_compile.compile(pyfn, cfile=None, dfile=None, doraise=True,
-                                   optimize=optimize)
-                logger.debug("succesfully compiled %s" % pyfn)
-            except Exception:
-                continue
-
-            # load the resulting .pyc file and compare it to the dropbox one
-            try:
-                libfile = os.path.join(pydir, "%s.cpython-37.opt-2.pyc" %
-                                       (fn[:-4]))
-                libfile = os.path.join(os.path.dirname(libfile),
-                                       "__pycache__",
-                                       os.path.basename(libfile))
-                with open(libfile, "rb") as f:
-                    f.read(16)
-                    data = f.read()
-                    orig_co = marshal.loads(data)
-                    logger.info("mapping %s to %s" % (remapped_co.co_filename,
-                                libfile))
-                    opc_map.map_co_objects(remapped_co, orig_co)
-
-                mapped += 1
-            except FileNotFoundError:
-                continue
     logger.info("Total .pyc files processed: %d" % total)
     logger.info("Total .pyc files mapped to Python standard library: %d" %
                 mapped)
+    if known:
+        logger.info("Total .pyc files already mapped in the opcode db: %d" %
+                    known)
 
 
 if __name__ == "__main__":
@@ -85,15 +107,41 @@ if __name__ == "__main__":
     parser.add_argument("--python-dir", required=True)
     parser.add_argument("--dropbox-zip", required=True)
     parser.add_argument("--db")
+    parser.add_argument("--cache",
+                        help="member cache file with decrypted marshal "
+                             "streams (created if it doesn't exist)")
+    parser.add_argument("--dropbox-version",
+                        help="Dropbox version to record in the opcode db "
+                             "(derived from the zip path if not given)")
+    parser.add_argument("--fresh", action="store_true",
+                        help="ignore the evidence in an existing opcode db "
+                             "instead of adding to it")
     ns = parser.parse_args()
 
     if not ns.db:
         ns.db = "opcode.db"
 
-    with opcodemap.OpcodeMapping(ns.db, True) as opc_map:
+    if not ns.dropbox_version:
+        m = re.search(r"dropbox-lnx[^/]*?-(\d+(\.\d+)+)", ns.dropbox_zip)
+        ns.dropbox_version = m.group(1) if m else ""
+
+    zip_hash = opcodemap.zip_sha256(ns.dropbox_zip)
+
+    with contextlib.ExitStack() as stack:
+        opc_map = stack.enter_context(opcodemap.OpcodeMapping(ns.db, True))
+        if ns.fresh:
+            opc_map.reset_evidence()
+        # a warm start keeps the recorded version unless there is a new one
+        if ns.dropbox_version:
+            opc_map.dropbox_version = ns.dropbox_version
+        opc_map.zip_hash = zip_hash
+        cache = None
+        if ns.cache:
+            cache = stack.enter_context(membercache.MemberCache(ns.cache))
         with zipfile.PyZipFile(ns.dropbox_zip,
                                "r",
                                zipfile.ZIP_DEFLATED) as zf:
 
             pydir = os.path.join(ns.python_dir, "Lib")
-            generate_opcode_mapping_from_zipfile(opc_map, zf, pydir)
+            generate_opcode_mapping_from_zipfile(opc_map, zf, pydir,
+                                                 cache=cache)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import logging
+import marshal
+import struct
+import sys
+import time
+import zipfile
+
+import unmarshaller
+import unpacker
+
+if sys.version_info[0] < 3:
+    raise Exception("This module is Python 3 only")
+
+logger = logging.getLogger(__name__)
+
+# Apart from the encrypted TYPE_CODE payloads the marshal stream is standard
+# Python 3.7 marshal. Instead of building every object with the pure Python
+# Unmarshaller the stream is walked once to decrypt the code object payloads
+# in place, which yields a standard marshal stream that is then turned into
+# the object graph by a single call to the C marshal module.
+#
+# Every decrypted payload is unmarshalled by Dropbox with a fresh reference
+# table and the code object itself never gets a reference slot. The stock
+# marshal module uses one table for the entire stream so reference flags on
+# code objects are dropped and TYPE_REF indices are renumbered on the way.
+
+_FLAG_REF = unmarshaller.FLAG_REF
+_LONG = struct.Struct("<l")
+_TWO_LONGS = struct.Struct("<LL")
+
+_EMPTY_TYPES = set(ord(x) for x in (unmarshaller.TYPE_NULL,
+                                    unmarshaller.TYPE_NONE,
+                                    unmarshaller.TYPE_FALSE,
+                                    unmarshaller.TYPE_TRUE,
+                                    unmarshaller.TYPE_STOPITER,
+                                    unmarshaller.TYPE_ELLIPSIS))
+_FIXED_TYPES = {
+    ord(unmarshaller.TYPE_INT): 4,
+    ord(unmarshaller.TYPE_INT64): 8,
+    ord(unmarshaller.TYPE_BINARY_FLOAT): 8,
+    ord(unmarshaller.TYPE_BINARY_COMPLEX): 16,
+}
+_SIZED_TYPES = set(ord(x) for x in (unmarshaller.TYPE_STRING,
+                                    unmarshaller.TYPE_INTERNED,
+                                    unmarshaller.TYPE_UNICODE,
+                                    unmarshaller.TYPE_ASCII,
+                                    unmarshaller.TYPE_ASCII_INTERNED))
+_SHORT_SIZED_TYPES = set(ord(x) for x in (
+    unmarshaller.TYPE_SHORT_ASCII, unmarshaller.TYPE_SHORT_ASCII_INTERNED))
+_SEQUENCE_TYPES = set(ord(x) for x in (unmarshaller.TYPE_TUPLE,
+                                       unmarshaller.TYPE_LIST,
+                                       unmarshaller.TYPE_SET,
+                                       unmarshaller.TYPE_FROZENSET))
+_TYPE_SMALL_TUPLE = ord(unmarshaller.TYPE_SMALL_TUPLE)
+_TYPE_DICT = ord(unmarshaller.TYPE_DICT)
+_TYPE_NULL = ord(unmarshaller.TYPE_NULL)
+_TYPE_REF = ord(unmarshaller.TYPE_REF)
+_TYPE_LONG = ord(unmarshaller.TYPE_LONG)
+_TYPE_FLOAT = ord(unmarshaller.TYPE_FLOAT)
+_TYPE_COMPLEX = ord(unmarshaller.TYPE_COMPLEX)
+_TYPE_CODE = ord(unmarshaller.TYPE_CODE)
+_TYPE_STRING = ord(unmarshaller.TYPE_STRING)
+
+
+class StreamDecrypter:
+    def __init__(self):
+        self.out = bytearray()
+        self.nrefs = 0
+        self.ncode = 0
+        self.key_time = 0.0
+        self.decrypt_time = 0.0
+        # optional callback applied to the co_code of every code object
+        self.code_transform = None
+
+    def w_object(self, buf, pos, refs):
+        code = buf[pos]
+        pos += 1
+        t = code & ~_FLAG_REF
+        out = self.out
+
+        if t == _TYPE_CODE:
+            rand, length = _TWO_LONGS.unpack_from(buf, pos)
+            pos += 8
+            sz = (length + 15) & ~0xf
+            if pos + sz > len(buf):
+                raise ValueError("bad marshal data (truncated code object)")
+            start = time.perf_counter()
+            key = unpacker.derive_key(rand, length)
+            mid = time.perf_counter()
+            body = unpacker.decipher_payload(buf[pos:pos+sz], key)
+            self.key_time += mid - start
+            self.decrypt_time += time.perf_counter() - mid
+            out.append(t)
+            self.ncode += 1
+            self.w_code(body, 0, [])
+            return pos + sz
+
+        if code & _FLAG_REF:
+            refs.append(self.nrefs)
+            self.nrefs += 1
+
+        if t == _TYPE_REF:
+            n, = _LONG.unpack_from(buf, pos)
+            if n < 0 or n >= len(refs):
+                raise ValueError("bad marshal data (invalid reference: %d)" %
+                                 n)
+            out.append(code)
+            out += _LONG.pack(refs[n])
+            return pos + 4
+
+        out.append(code)
+        if t in _EMPTY_TYPES:
+            return pos
+        if t in _FIXED_TYPES:
+            end = pos + _FIXED_TYPES[t]
+        elif t in _SIZED_TYPES:
+            n, = _LONG.unpack_from(buf, pos)
+            end = pos + 4 + n
+        elif t in _SHORT_SIZED_TYPES:
+            end = pos + 1 + buf[pos]
+        elif t == _TYPE_LONG:
+            n, = _LONG.unpack_from(buf, pos)
+            end = pos + 4 + 2 * abs(n)
+        elif t == _TYPE_FLOAT:
+            end = pos + 1 + buf[pos]
+        elif t == _TYPE_COMPLEX:
+            end = pos + 1 + buf[pos]
+            end = end + 1 + buf[end]
+        elif t in _SEQUENCE_TYPES:
+            n, = _LONG.unpack_from(buf, pos)
+            out += buf[pos:pos+4]
+            pos += 4
+            for _ in range(n):
+                pos = self.w_object(buf, pos, refs)
+            return pos
+        elif t == _TYPE_SMALL_TUPLE:
+            n = buf[pos]
+            out.append(n)
+            pos += 1
+            for _ in range(n):
+                pos = self.w_object(buf, pos, refs)
+            return pos
+        elif t == _TYPE_DICT:
+            while buf[pos] != _TYPE_NULL:
+                pos = self.w_object(buf, pos, refs)
+                pos = self.w_object(buf, pos, refs)
+            out.append(_TYPE_NULL)
+            return pos + 1
+        else:
+            raise ValueError("invalid marshal code: %c (%d)" % (t, t))
+        if end > len(buf):
+            raise ValueError("bad marshal data (truncated)")
+        out += buf[pos:end]
+        return end
+
+    def w_code(self, buf, pos, refs):
+        # argcount, kwonlyargcount, nlocals, stacksize and flags
+        self.out += buf[pos:pos+20]
+        pos += 20
+        # code, consts, names, varnames, freevars, cellvars, filename, name;
+        # the bytes of the code are transformed in place in the output. A
+        # reference instead of a string points to code that has already been
+        # transformed.
+        start = len(self.out)
+        pos = self.w_object(buf, pos, refs)
+        if self.code_transform is not None and \
+                self.out[start] & ~_FLAG_REF == _TYPE_STRING:
+            self.out[start+5:] = self.code_transform(bytes(
+                self.out[start+5:]))
+        for _ in range(7):
+            pos = self.w_object(buf, pos, refs)
+        # firstlineno followed by lnotab
+        self.out += buf[pos:pos+4]
+        pos += 4
+        return self.w_object(buf, pos, refs)
+
+
+def decrypt_stream(data):
+    # returns the standard marshal stream for an encrypted marshal stream
+    # (i.e. a pyc file without its 16 byte header)
+    sd = StreamDecrypter()
+    sd.w_object(memoryview(data), 0, [])
+    return bytes(sd.out)
+
+
+def load_pyc(data, opc_map=None):
+    sd = StreamDecrypter()
+    if opc_map is not None:
+        sd.code_transform = unpacker.code_remapper(opc_map)
+    sd.w_object(memoryview(data)[16:], 0, [])
+    return marshal.loads(sd.out)
+
+
+def benchmark(zf, limit=None):
+    fns = [x for x in zf.namelist() if x[-3:] == "pyc"][:limit]
+    members = [zf.read(x) for x in fns]
+    nbytes = sum(len(x) for x in members)
+
+    start = time.perf_counter()
+    for data in members:
+        um = unmarshaller.Unmarshaller(io.BytesIO(data[16:]).read)
+        um.dispatch[unmarshaller.TYPE_CODE] = \
+            (unpacker.load_code_without_patching, "TYPE_CODE")
+        um.load()
+    pure = time.perf_counter() - start
+
+    decrypt = 0.0
+    start = time.perf_counter()
+    for data in members:
+        sd = StreamDecrypter()
+        sd.w_object(memoryview(data)[16:], 0, [])
+        marshal.loads(sd.out)
+        decrypt += sd.key_time + sd.decrypt_time
+    hybrid = time.perf_counter() - start
+
+    print("%d files, %.1f MB" % (len(members), nbytes / 1e6))
+    print("pure Python Unmarshaller: %8.3fs (%.2f MB/s)" %
+          (pure, nbytes / 1e6 / pure))
+    print("hybrid loader:            %8.3fs (%.2f MB/s)" %
+          (hybrid, nbytes / 1e6 / hybrid))
+    print("speedup: %.2fx" % (pure / hybrid))
+    print("time spent in XXTEA decryption: %.3fs (%.0f%% of hybrid)" %
+          (decrypt, 100 * decrypt / hybrid))
+    print("unmarshalling without decryption: pure %.3fs vs hybrid %.3fs" %
+          (pure - decrypt, hybrid - decrypt))
+
+
+if __name__ == "__main__":
+
+    root = logging.getLogger()
+    root.setLevel(logging.WARNING)
+    handler = logging.StreamHandler(sys.stdout)
+    formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    root.addHandler(handler)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dropbox-zip", required=True,
+                        help="zipfile containing the dropbox obfuscated code")
+    parser.add_argument("--limit", type=int,
+                        help="only benchmark the first N pyc files")
+    ns = parser.parse_args()
+
+    with zipfile.PyZipFile(ns.dropbox_zip, "r", zipfile.ZIP_DEFLATED) as zf:
+        benchmark(zf, ns.limit)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import dis
+import json
+import logging
+import sys
+import time
+import types
+
+import membercache
+import mmapzip
+import opcodemap
+import unpacker
+
+if sys.version_info[0] < 3:
+    raise Exception("This module is Python 3 only")
+
+logger = logging.getLogger(__name__)
+
+# Builds the module dependency graph of a zip straight from the remapped
+# bytecode. In Python 3.7 every import statement compiles to
+#
+#   LOAD_CONST level, LOAD_CONST fromlist, IMPORT_NAME name
+#
+# so the imports of a module (including the ones inside functions) can be
+# read off its code objects without decompiling anything. Imports done
+# through importlib or __import__ with computed names are not found.
+
+
+def module_name(fn):
+    # returns the dotted module name of a pyc file in the zip and whether it
+    # is the __init__ of a package
+    parts = fn[:-4].split("/")
+    if parts[-1] == "__init__":
+        return ".".join(parts[:-1]), True
+    return ".".join(parts), False
+
+
+def scan_imports(co):
+    # returns (name, fromlist, level) for every import in co and the code
+    # objects nested in it
+    imports = set()
+    todo = [co]
+    while todo:
+        co = todo.pop()
+        consts = []
+        for instr in dis.get_instructions(co):
+            if instr.opname == "LOAD_CONST":
+                consts = consts[-1:] + [instr.argval]
+            elif instr.opname == "IMPORT_NAME":
+                level, fromlist = 0, None
+                if len(consts) == 2:
+                    level, fromlist = consts
+                imports.add((instr.argval, tuple(fromlist or ()), level))
+                consts = []
+            else:
+                consts = []
+        todo.extend(x for x in co.co_consts if isinstance(x, types.CodeType))
+    return imports
+
+
+def parents(name):
+    parts = name.split(".")
+    return [".".join(parts[:i]) for i in range(1, len(parts))]
+
+
+class ImportGraph:
+    def __init__(self):
+        # module name -> pyc file in the zip
+        self.modules = {}
+        # module name -> names of the modules it imports
+        self.imports = {}
+        # module name -> names imported with "from x import y" as x.y, which
+        # are only modules if they are in the zip
+        self.submodules = {}
+
+    def add(self, fn, co):
+        name, is_package = module_name(fn)
+        self.modules[name] = fn
+        package = name if is_package else name.rpartition(".")[0]
+        targets = set()
+        submodules = set()
+        for target, fromlist, level in scan_imports(co):
+            if level > 0:
+                base = package.split(".")
+                base = base[:len(base) - level + 1]
+                if not base or not base[0]:
+                    logger.debug("relative import beyond the top-level "
+                                 "package in %s" % fn)
+                    continue
+                target = ".".join(base + ([target] if target else []))
+            targets.add(target)
+            submodules.update("%s.%s" % (target, x) for x in fromlist
+                              if x != "*")
+        # "from . import x" in a package's __init__
+        targets.discard(name)
+        self.imports[name] = targets
+        self.submodules[name] = submodules
+
+    def resolve(self):
+        # adds the modules imported with "from package import module" once
+        # all the modules in the zip are known
+        for name, submodules in self.submodules.items():
+            self.imports[name].update(x for x in submodules
+                                      if x in self.modules)
+        self.submodules = {}
+
+    @classmethod
+    def build(cls, zf, opc_map, cache=None):
+        graph = cls()
+        start = time.perf_counter()
+        for fn in zf.namelist():
+            if fn[-3:] != "pyc":
+                continue
+            try:
+                co = unpacker.load_pyc(zf, fn, opc_map, cache)
+            except Exception as e:
+                logger.error("cannot load %s (%s), leaving it out" %
+                             (fn, str(e)))
+                continue
+            graph.add(fn, co)
+        graph.resolve()
+        logger.info("scanned the imports of %d modules in %.2fs" %
+                    (len(graph.modules), time.perf_counter() - start))
+        return graph
+
+    def closure(self, roots):
+        # the modules in the zip that importing roots (transitively) loads,
+        # including the packages they are in
+        seen = set()
+        todo = list(roots)
+        while todo:
+            name = todo.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            todo.extend(parents(name))
+            todo.extend(self.imports.get(name, ()))
+        return set(x for x in seen if x in self.modules)
+
+    def files(self, names):
+        return set(self.modules[x] for x in names)
+
+    def to_dict(self, names=None):
+        if names is None:
+            names = self.modules
+        return {
+            "modules": dict((x, {"file": self.modules[x],
+                                 "imports": sorted(self.imports[x])})
+                            for x in sorted(names)),
+            "external": sorted(set(y for x in names for y in self.imports[x]
+                                   if y not in self.modules)),
+        }
+
+    def write_json(self, fn, names=None):
+        with open(fn, "w") as fd:
+            json.dump(self.to_dict(names), fd, indent=1, sort_keys=True)
+
+    def write_dot(self, fn, names=None, external=False):
+        if names is None:
+            names = self.modules
+        with open(fn, "w") as fd:
+            fd.write("digraph imports {\n")
+            for name in sorted(names):
+                fd.write("  \"%s\";\n" % name)
+                for target in sorted(self.imports[name]):
+                    if target in self.modules or external:
+                        fd.write("  \"%s\" -> \"%s\";\n" % (name, target))
+            fd.write("}\n")
+
+
+if __name__ == "__main__":
+
+    root = logging.getLogger()
+    root.setLevel(logging.WARNING)
+    logger.setLevel(logging.DEBUG)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    root.addHandler(handler)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dropbox-zip", required=True,
+                        help="zipfile containing the dropbox obfuscated code")
+    parser.add_argument("--db", default="opcode.db",
+                        help="opcode database file to use")
+    parser.add_argument("--cache",
+                        help="member cache file with decrypted marshal "
+                             "streams (created if it doesn't exist)")
+    parser.add_argument("--json", default="imports.json",
+                        help="output file for the graph as JSON")
+    parser.add_argument("--dot",
+                        help="output file for the graph in Graphviz format")
+    parser.add_argument("--external", action="store_true",
+                        help="include the modules that aren't in the zip in "
+                             "the Graphviz output")
+    parser.add_argument("--root", action="append", default=[],
+                        help="only output the modules loaded by importing "
+                             "this module (can be given more than once)")
+    ns = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        opc_map = stack.enter_context(opcodemap.OpcodeMapping(ns.db, False))
+        cache = None
+        if ns.cache:
+            cache = stack.enter_context(membercache.MemberCache(ns.cache))
+        zf = stack.enter_context(mmapzip.open_zipfile(ns.dropbox_zip))
+        graph = ImportGraph.build(zf, opc_map, cache)
+
+    names = None
+    if ns.root:
+        names = graph.closure(ns.root)
+        logger.info("%d modules are loaded by importing %s" %
+                    (len(names), ", ".join(ns.root)))
+    graph.write_json(ns.json, names)
+    if ns.dot:
+        graph.write_dot(ns.dot, names, ns.external)
@@ -0,0 +1,108 @@
+import logging
+import mmap
+import os
+import struct
+
+
+logger = logging.getLogger(__name__)
+
+# The member cache holds the fully decrypted but still opcode-obfuscated pyc
+# files of a zip, i.e. the pyc header followed by a standard marshal stream
+# that can be fed straight to marshal.loads(). Entries are keyed by the CRC
+# and uncompressed size of the zip member. The file consists of a header, an
+# index of fixed-size entries and the blobs themselves so that it can be
+# memory-mapped and a blob read without parsing any of the others. get()
+# returns copies as the mapping can't be closed while views of it exist.
+CACHE_MAGIC = b"LITBCACH"
+CACHE_FORMAT_VERSION = 1
+CACHE_HEADER = struct.Struct("<8sLL")
+CACHE_ENTRY = struct.Struct("<LLQQ")
+
+
+class MemberCache:
+    def __init__(self, fn):
+        self.fn = fn
+        self.index = {}
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self._fd = None
+        self._mm = None
+
+    def __enter__(self):
+        try:
+            self._fd = open(self.fn, "rb")
+        except FileNotFoundError:
+            return self
+        if os.fstat(self._fd.fileno()).st_size == 0:
+            return self
+        self._mm = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = CACHE_HEADER.unpack_from(self._mm)
+        if magic != CACHE_MAGIC or version != CACHE_FORMAT_VERSION:
+            logger.warning("ignoring member cache %s with unknown format" %
+                           self.fn)
+            return self
+        off = CACHE_HEADER.size
+        for _ in range(count):
+            crc, size, data_off, data_len = CACHE_ENTRY.unpack_from(self._mm,
+                                                                    off)
+            self.index[(crc, size)] = (data_off, data_len)
+            off += CACHE_ENTRY.size
+        logger.debug("loaded %d entries from member cache %s" %
+                     (count, self.fn))
+        return self
+
+    def __exit__(self, extype, exvalue, traceback):
+        logger.info("member cache: %d hits, %d misses" %
+                    (self.hits, self.misses))
+        if self.pending:
+            self.write()
+        self.close()
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+    def get(self, info):
+        key = (info.CRC, info.file_size)
+        if key in self.pending:
+            self.hits += 1
+            return self.pending[key]
+        entry = self.index.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        data_off, data_len = entry
+        return self._mm[data_off:data_off+data_len]
+
+    def put(self, info, data):
+        self.pending[(info.CRC, info.file_size)] = bytes(data)
+
+    def write(self):
+        # merge the existing entries with the pending ones and write the
+        # result to a temporary file first as the old file is still mapped
+        entries = []
+        for key, (data_off, data_len) in self.index.items():
+            if key not in self.pending:
+                entries.append((key, self._mm[data_off:data_off+data_len]))
+        entries.extend(self.pending.items())
+
+        tmpfn = "%s.tmp" % self.fn
+        with open(tmpfn, "wb") as fd:
+            fd.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_FORMAT_VERSION,
+                                       len(entries)))
+            data_off = CACHE_HEADER.size + len(entries) * CACHE_ENTRY.size
+            for (crc, size), data in entries:
+                fd.write(CACHE_ENTRY.pack(crc, size, data_off, len(data)))
+                data_off += len(data)
+            for _, data in entries:
+                fd.write(data)
+        self.close()
+        os.replace(tmpfn, self.fn)
+        logger.info("wrote %d entries to member cache %s" %
+                    (len(entries), self.fn))
@@ -0,0 +1,135 @@
+import collections
+import io
+import logging
+import mmap
+import struct
+import zipfile
+import zlib
+
+
+logger = logging.getLogger(__name__)
+
+# A read-only zip reader for the python-packages zip that maps the whole file
+# and parses the central directory once into a compact index. Deflated
+# members are inflated with a single zlib call straight from the mapping and
+# stored members are copied out of it with a single slice; read() never
+# returns views of the mapping as close() fails while any of them exist. Only
+# the parts of the zipfile API used by the tools in this repository are
+# provided.
+
+_EOCD = struct.Struct("<4s4H2LH")
+_EOCD_MAGIC = b"PK\x05\x06"
+_CENTRAL = struct.Struct("<4s6H3L5H2L")
+_CENTRAL_MAGIC = b"PK\x01\x02"
+_LOCAL = struct.Struct("<4s5H3L2H")
+_LOCAL_MAGIC = b"PK\x03\x04"
+
+# the fields are named after the ZipInfo attributes such that the entries can
+# be used wherever a ZipInfo is expected (e.g. by the member cache)
+MemberInfo = collections.namedtuple("MemberInfo", (
+    "filename", "header_offset", "compress_type", "compress_size",
+    "file_size", "CRC"))
+
+
+class MappedZipFile:
+    def __init__(self, fn):
+        self.fn = fn
+        self.comment = b""
+        self._fd = open(fn, "rb")
+        try:
+            self._mm = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+            self._index = self._read_central_directory()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, extype, exvalue, traceback):
+        self.close()
+
+    def close(self):
+        if getattr(self, "_mm", None) is not None:
+            self._mm.close()
+            self._mm = None
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+    def _read_central_directory(self):
+        mm = self._mm
+        # the end of central directory record is followed by a comment of at
+        # most 64k
+        pos = mm.rfind(_EOCD_MAGIC, max(0, len(mm) - _EOCD.size - 0xffff))
+        if pos < 0:
+            raise zipfile.BadZipFile("%s is not a zip file" % self.fn)
+        (_, disk, _, _, count, cd_size, cd_offset,
+         comment_len) = _EOCD.unpack_from(mm, pos)
+        if disk != 0 or count == 0xffff or cd_offset == 0xffffffff:
+            raise zipfile.BadZipFile("multi-disk and zip64 archives are not "
+                                     "supported")
+        self.comment = bytes(mm[pos+_EOCD.size:pos+_EOCD.size+comment_len])
+
+        index = collections.OrderedDict()
+        off = cd_offset
+        for _ in range(count):
+            fields = _CENTRAL.unpack_from(mm, off)
+            if fields[0] != _CENTRAL_MAGIC:
+                raise zipfile.BadZipFile("bad central directory entry at %d" %
+                                         off)
+            flags, method = fields[3], fields[4]
+            crc, csize, size = fields[7], fields[8], fields[9]
+            name_len, extra_len, comment_len = fields[10:13]
+            header_offset = fields[16]
+            name = bytes(mm[off+_CENTRAL.size:off+_CENTRAL.size+name_len])
+            name = name.decode("utf-8" if flags & 0x800 else "cp437")
+            index[name] = MemberInfo(name, header_offset, method, csize, size,
+                                     crc)
+            off += _CENTRAL.size + name_len + extra_len + comment_len
+        return index
+
+    def namelist(self):
+        return list(self._index)
+
+    def infolist(self):
+        return list(self._index.values())
+
+    def getinfo(self, name):
+        try:
+            return self._index[name]
+        except KeyError:
+            raise KeyError("There is no item named %r in the archive" % name)
+
+    def read(self, name):
+        info = name if isinstance(name, MemberInfo) else self.getinfo(name)
+        mm = self._mm
+        fields = _LOCAL.unpack_from(mm, info.header_offset)
+        if fields[0] != _LOCAL_MAGIC:
+            raise zipfile.BadZipFile("bad local file header for %s" %
+                                     info.filename)
+        start = info.header_offset + _LOCAL.size + fields[9] + fields[10]
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            with memoryview(mm)[start:start+info.compress_size] as view:
+                data = zlib.decompress(view, -15, info.file_size)
+        elif info.compress_type == zipfile.ZIP_STORED:
+            data = mm[start:start+info.compress_size]
+        else:
+            raise NotImplementedError("compression method %d is not "
+                                      "supported" % info.compress_type)
+        if zlib.crc32(data) != info.CRC:
+            raise zipfile.BadZipFile("bad CRC-32 for %s" % info.filename)
+        return data
+
+    def open(self, name, mode="r"):
+        return io.BytesIO(self.read(name))
+
+
+def open_zipfile(fn):
+    # the mapped reader for the archives it supports and zipfile otherwise
+    try:
+        return MappedZipFile(fn)
+    except (zipfile.BadZipFile, NotImplementedError, ValueError) as e:
+        logger.warning("cannot map %s (%s), using zipfile instead" %
+                       (fn, str(e)))
+        return zipfile.PyZipFile(fn, "r", zipfile.ZIP_DEFLATED)
@@ -1,10 +1,86 @@
+import dis
+import hashlib
+import io
 import logging
 import pickle
+import struct
 import types
 
 
 logger = logging.getLogger(__name__)
 
+# The opcode database is a fixed-layout binary file. It starts with a header
+# describing which Dropbox build and Python version it was generated for and
+# is followed by a 256-byte forward table (Dropbox opcode -> Python opcode), a
+# 256-byte reverse table (Python opcode -> Dropbox opcode) and a 256-byte
+# confidence array. A confidence of 0 means the opcode was never observed and
+# is mapped onto itself.
+#
+# Since version 2 the tables are followed by the evidence they were derived
+# from: the number of times every (Dropbox opcode, Python opcode) pair was
+# seen and the (name, CRC) of every member that was mapped. gendb adds to that
+# evidence on the next run instead of starting over.
+DB_MAGIC = b"LITBOPC\x00"
+DB_FORMAT_VERSION = 2
+DB_HEADER = struct.Struct("<8sI32s4s32s")
+DB_TABLE_SIZE = 256
+DB_SIZE = DB_HEADER.size + 3 * DB_TABLE_SIZE
+DB_COUNT = struct.Struct("<I")
+DB_EVIDENCE = struct.Struct("<BBI")
+DB_MEMBER = struct.Struct("<IH")
+
+
+def zip_sha256(fn):
+    # the hash recorded in the header, computed without reading the whole zip
+    # into memory
+    h = hashlib.sha256()
+    with open(fn, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1 << 20), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+def _identity():
+    return bytes(range(DB_TABLE_SIZE))
+
+
+class _TableUnpickler(pickle.Unpickler):
+    # a dict of ints doesn't need any globals, so refuse to import anything
+    # such that unpickling a crafted file can't run code
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError("legacy opcode db refers to %s.%s" %
+                                     (module, name))
+
+
+def _convert_legacy(data):
+    # older versions of gendb pickled the sanitized table dictionary as-is;
+    # only ever accept a dict of small ints from it
+    table = _TableUnpickler(io.BytesIO(data)).load()
+    if not isinstance(table, dict):
+        raise Exception("legacy opcode db doesn't contain a dictionary")
+    for key, value in table.items():
+        if not (type(key) is int and type(value) is int and
+                0 <= key < DB_TABLE_SIZE and 0 <= value < DB_TABLE_SIZE):
+            raise Exception("legacy opcode db contains invalid opcodes")
+    return table
+
+
+def _best(counts, key):
+    # the most seen opcode other than key itself and how often it was seen
+    best = None
+    maxcnt = 0
+    for i, count in counts.items():
+        if i == key:
+            continue
+        if maxcnt < count:
+            maxcnt = count
+            best = i
+    return best, maxcnt
+
+
+def _opname(op):
+    return "%s (%d)" % (dis.opname[op], op)
+
 
 class OpcodeMapping:
     # before using always need to call sanitize()
@@ -15,34 +91,160 @@ class OpcodeMapping:
         self.co_len_mismatch = 0
         self.co_matched = 0
         self.loaded_from_fs = False
+        self.load_failed = False
         self.overwrite = overwrite
         self.missing = {}
+        self._clear()
+
+    def _clear(self):
+        self.table = {}
+        self.map = {}
+        self.translation = _identity()
+        self.confidence = bytes(DB_TABLE_SIZE)
+        self.dropbox_version = ""
+        self.pyc_magic = bytes(4)
+        self.zip_hash = bytes(32)
+        # (name, CRC) of the members whose evidence is in self.map
+        self.members = set()
+        # the table and evidence as loaded, to tell what a run added
+        self.loaded_table = {}
+        self.loaded_map = {}
 
     def __enter__(self):
         logger.debug("__enter__ opcodemapping")
         try:
             with open(self.fn, "rb") as fd:
-                data = pickle.load(fd)
+                data = fd.read()
         except Exception:
             return self
+        try:
+            if data[:len(DB_MAGIC)] == DB_MAGIC:
+                self.load(data)
+            else:
+                logger.warning("converting legacy opcode db %s" % self.fn)
+                self.table = _convert_legacy(data)
+                self.confidence = bytes(0xff if i in self.table else 0
+                                        for i in range(DB_TABLE_SIZE))
+                self._build_translation()
+        except Exception as e:
+            # like a missing db, a corrupt one leaves the mapping empty
+            logger.warning("cannot load opcode db %s (%s), using an empty "
+                           "mapping" % (self.fn, str(e)))
+            self._clear()
+            self.load_failed = True
+            return self
         self.loaded_from_fs = True
-        self.table = data
+        if self.overwrite and self.table and not self.map:
+            self._seed_evidence()
+        self.loaded_table = dict(self.table)
+        self.loaded_map = dict((k, dict(v)) for k, v in self.map.items())
         return self
 
+    def _seed_evidence(self):
+        # version 1 and legacy dbs only have the tables; use the confidences
+        # as counts such that the opcodes a new run doesn't see keep their
+        # mapping instead of falling back to the identity
+        logger.warning("%s holds no evidence, using its table with the "
+                       "confidences as counts" % self.fn)
+        for key, value in self.table.items():
+            self.map[key] = {value: max(1, self.confidence[key])}
+
     def __exit__(self, extype, exvalue, traceback):
-        if not self.overwrite and self.loaded_from_fs:
+        if extype is not None:
+            # don't replace the db with the evidence of a run that failed
+            logger.warning("NOT writing opcode map after an error")
+            return
+        if not self.overwrite and (self.loaded_from_fs or self.load_failed):
             # if caller didn't specify a force overwrite and this opcode
-            # mapping was loaded from the filesystem don't do anything
+            # mapping was loaded from the filesystem (or is there but can't
+            # be loaded) don't do anything
             logger.warning("NOT writing opcode map as force overwrite not set")
             return
 
         logger.warning("stats: co_len_mismatch=%i, co_matched=%i" %
                        (self.co_len_mismatch, self.co_matched))
 
+        for key, old, new in self.conflicts():
+            logger.warning("conflicting evidence for dropbox opcode %d: "
+                           "mapped to %s before, this run says %s" %
+                           (key, _opname(old), _opname(new)))
+
         logger.warning("opcode map database is being sanitized and written")
         self.sanitize()
-        with open(self.fn, "wb") as fd:
-            pickle.dump(self.table, fd)
+        self.write(self.fn)
+
+    def load(self, data):
+        if len(data) < DB_SIZE:
+            raise Exception("opcode db is truncated")
+        magic, version, dbx_version, pyc_magic, zip_hash = \
+            DB_HEADER.unpack_from(data)
+        if version not in (1, DB_FORMAT_VERSION):
+            raise Exception("unsupported opcode db version %d" % version)
+        off = DB_HEADER.size
+        forward = data[off:off+DB_TABLE_SIZE]
+        off += 2 * DB_TABLE_SIZE
+        confidence = data[off:off+DB_TABLE_SIZE]
+
+        self.dropbox_version = dbx_version.rstrip(b"\x00").decode("utf-8")
+        self.pyc_magic = pyc_magic
+        self.zip_hash = zip_hash
+        self.translation = bytes(forward)
+        self.confidence = bytes(confidence)
+        self.table = dict((i, forward[i]) for i in range(DB_TABLE_SIZE)
+                          if confidence[i])
+        if version > 1:
+            self._load_evidence(data, DB_SIZE)
+
+    def _load_evidence(self, data, off):
+        self.map = {}
+        self.members = set()
+        try:
+            count, = DB_COUNT.unpack_from(data, off)
+            off += DB_COUNT.size
+            for _ in range(count):
+                key, op, n = DB_EVIDENCE.unpack_from(data, off)
+                off += DB_EVIDENCE.size
+                self.map.setdefault(key, {})[op] = n
+            count, = DB_COUNT.unpack_from(data, off)
+            off += DB_COUNT.size
+            for _ in range(count):
+                crc, name_len = DB_MEMBER.unpack_from(data, off)
+                off += DB_MEMBER.size
+                name = data[off:off+name_len].decode("utf-8")
+                off += name_len
+                self.members.add((name, crc))
+        except struct.error:
+            raise Exception("opcode db evidence is truncated")
+
+    def write(self, fn):
+        reverse = bytearray(_identity())
+        for key, val in self.table.items():
+            reverse[val] = key
+        dbx_version = self.dropbox_version.encode("utf-8")
+        if len(dbx_version) > 32:
+            raise Exception("dropbox version string too long")
+        with open(fn, "wb") as fd:
+            fd.write(DB_HEADER.pack(DB_MAGIC, DB_FORMAT_VERSION, dbx_version,
+                                    self.pyc_magic, self.zip_hash))
+            fd.write(self.translation)
+            fd.write(reverse)
+            fd.write(self.confidence)
+            evidence = sorted((key, op, n) for key, v in self.map.items()
+                              for op, n in v.items())
+            fd.write(DB_COUNT.pack(len(evidence)))
+            for x in evidence:
+                fd.write(DB_EVIDENCE.pack(*x))
+            fd.write(DB_COUNT.pack(len(self.members)))
+            for name, crc in sorted(self.members):
+                name = name.encode("utf-8")
+                fd.write(DB_MEMBER.pack(crc, len(name)))
+                fd.write(name)
+
+    def _build_translation(self):
+        translation = bytearray(_identity())
+        for key, val in self.table.items():
+            translation[key] = val
+        self.translation = bytes(translation)
 
     def _map_co_objects(self, a, b):
         if len(a.co_code) != len(b.co_code):
@@ -66,18 +268,49 @@ class OpcodeMapping:
 
     def sanitize(self):
         table = {}
+        confidence = bytearray(DB_TABLE_SIZE)
         keys = sorted(self.map.keys())
         for key in keys:
-            maxcnt = 0
-            for i, count in self.map[key].items():
-                if i == key:
-                    continue
-                if maxcnt < count:
-                    maxcnt = count
-                    table[key] = i
+            best, maxcnt = _best(self.map[key], key)
+            if best is not None:
+                table[key] = best
+                total = sum(self.map[key].values())
+                confidence[key] = max(1, (maxcnt * 0xff) // total)
         self.table = table
+        self.confidence = bytes(confidence)
+        self._build_translation()
         self.missing = {}
 
+    def has_member(self, info):
+        return (info.filename, info.CRC) in self.members
+
+    def add_member(self, info):
+        self.members.add((info.filename, info.CRC))
+
+    def reset_evidence(self):
+        # forget the evidence loaded from the db such that it is rebuilt
+        # from scratch
+        self.map = {}
+        self.members = set()
+        self.loaded_table = {}
+        self.loaded_map = {}
+
+    def conflicts(self):
+        # (dropbox opcode, old, new) for the opcodes the evidence added since
+        # loading maps onto a different Python opcode than the loaded table
+        conflicts = []
+        for key in sorted(self.map):
+            old = self.loaded_table.get(key)
+            if old is None:
+                continue
+            loaded = self.loaded_map.get(key, {})
+            added = dict((i, n - loaded.get(i, 0))
+                         for i, n in self.map[key].items())
+            new, _ = _best(added, key)
+            if new is not None and new != old:
+                conflicts.append((key, old, new))
+        return conflicts
+
     def get(self, op):
         if op not in self.table:
             self.missing[op] = self.missing.get(op, 0) + 1
@@ -6,7 +6,6 @@ import logging
 import sys
 import struct
 import zipfile
-import types
 import io
 
 import tea
@@ -28,7 +27,7 @@ def read_wrapper(self, readfn):
     return fn
 
 
-def dump_code_wrapper(self, co):
+def dump_code_wrapper(self, co, rand=0x00000000):
     start_off = self._buf.tell()
     self.dump_code(co)
     self._buf.flush()
@@ -40,7 +39,6 @@ def dump_code_wrapper(self, co):
     data = self._buf.read(ln)
     data = data[1:]
 
-    rand = 0x00000000
     length = len(data)
     sz = (length + 15) & ~0xf
     words = sz / 4
@@ -67,7 +65,7 @@ def dump_code_wrapper(self, co):
     self._write(data)
 
 
-def load_code(self, search, replace):
+def load_code(self):
     rand = self.r_long()
     length = self.r_long()
 
@@ -92,11 +90,14 @@ def load_code(self, search, replace):
     iodata = io.BytesIO(data)
     um = unmarshaller.Unmarshaller(read_wrapper(self, iodata.read))
     # make sure that the rest is being marshalled with the same TYPE_CODE
-    # dispatch method as is being used for the current code object such that we
-    # end up with a consistent ummarshalled object structure (instead of for
-    # example having parent code level objects being opcode-remapped and child
-    # objects still having the obfuscated opcode-mapping.
+    # dispatch method and field transforms as are being used for the current
+    # code object such that we end up with a consistent ummarshalled object
+    # structure (instead of for example having parent code level objects
+    # being opcode-remapped and child objects still having the obfuscated
+    # opcode-mapping.
     um.opcode_mapping = self.opcode_mapping
+    um.code_transform = self.code_transform
+    um.consts_transform = self.consts_transform
     um.dispatch[unmarshaller.TYPE_CODE] = self.dispatch[unmarshaller.TYPE_CODE]
     um.flags.append(0)
     um.depth = self.depth
@@ -105,21 +106,14 @@ def load_code(self, search, replace):
 
 
 def replace_hash(search, replace):
-    def fn(self):
-        code = load_code(self, search, replace)
-        if search in code.co_consts:
-            logging.info("replacing %s with %s in %s at line %i" %
-                         (search, replace, code.co_filename,
-                          code.co_firstlineno))
-        consts = [x if x != search else replace for x in list(code.co_consts)]
-        ret_co = types.CodeType(code.co_argcount, code.co_kwonlyargcount,
-                                code.co_nlocals, code.co_stacksize,
-                                code.co_flags, code.co_code, tuple(consts),
-                                code.co_names, code.co_varnames,
-                                code.co_filename, code.co_name,
-                                code.co_firstlineno, code.co_lnotab,
-                                code.co_freevars, code.co_cellvars)
-        return ret_co
+    # consts transform for the Unmarshaller such that the constants are
+    # replaced before the code object is created
+    def fn(consts, filename, firstlineno):
+        if search not in consts:
+            return consts
+        logging.info("replacing %s with %s in %s at line %i" %
+                     (search, replace, filename, firstlineno))
+        return tuple(x if x != search else replace for x in consts)
     return fn
 
 
@@ -160,12 +154,10 @@ if __name__ == "__main__":
             with zf.open(fn, "r") as f:
 
                 data = f.read(16)
-                ulc = unpacker.load_code_without_patching
                 um = unmarshaller.Unmarshaller(f.read)
                 um._read = read_wrapper(um, f.read)  # XXX dirty
-                um.dispatch[unmarshaller.TYPE_CODE] = (replace_hash(hashes[fn],
-                                                       replace_str),
-                                                       "TYPE_CODE")
+                um.consts_transform = replace_hash(hashes[fn], replace_str)
+                um.dispatch[unmarshaller.TYPE_CODE] = (load_code, "TYPE_CODE")
                 co = um.load()
 
                 with io.BytesIO() as out:
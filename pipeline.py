@@ -0,0 +1,584 @@
+import logging
+import marshal
+import multiprocessing
+import os
+import queue
+import shutil
+import threading
+import time
+
+import fingerprint
+import mmapzip
+import profiler
+import splitdeparse
+import stagetrace
+import unpacker
+
+
+logger = logging.getLogger(__name__)
+
+# The unpacker runs as a three stage pipeline. A reader thread reads (and
+# inflates, zlib releases the GIL while doing so) the members from the zip, the
+# members are decrypted, remapped and decompiled either on the main thread or
+# in a pool of worker processes and a writer thread creates the output files.
+# The stages are connected by bounded queues such that a slow stage holds
+# back the others instead of piling up members in memory.
+
+_STOP = None
+
+
+class BoundedQueue(queue.Queue):
+    # a queue that keeps track of how often and how long producers had to wait
+    # for room in it, i.e. the backpressure from the consuming stage
+    def __init__(self, name, maxsize):
+        super().__init__(maxsize)
+        self.name = name
+        self.puts = 0
+        self.blocked = 0
+        self.blocked_time = 0.0
+        self.max_depth = 0
+
+    def put(self, item, block=True, timeout=None):
+        self.puts += 1
+        try:
+            super().put(item, False)
+        except queue.Full:
+            start = time.perf_counter()
+            super().put(item, block, timeout)
+            self.blocked += 1
+            self.blocked_time += time.perf_counter() - start
+        self.max_depth = max(self.max_depth, self.qsize())
+
+    def report(self):
+        logger.info("%s queue: %d items, producer blocked %d times for "
+                    "%.2fs, max depth %d/%d" %
+                    (self.name, self.puts, self.blocked, self.blocked_time,
+                     self.max_depth, self.maxsize))
+
+
+# settings of the processing stage, set in every worker process (or in the
+# main process when running without workers) by _init_worker
+_worker = {}
+
+
+def _init_worker(opc_map, stdlib, dedup, keep_stream, fallback=None,
+                 emit="source", zf=None):
+    _worker["opc_map"] = opc_map
+    _worker["stdlib"] = stdlib
+    _worker["dedup"] = dedup
+    _worker["keep_stream"] = keep_stream
+    _worker["fallback"] = fallback
+    _worker["emit"] = emit
+    _worker["zf"] = zf
+
+
+def load_member(fn, size, raw, data, read_time):
+    # decrypts, remaps and fingerprints a member; returns the member trace,
+    # the code object, the decrypted stream if it is new and has to go into
+    # the member cache, the content hash and the matching stdlib module
+    mt = stagetrace.MemberTrace(fn)
+    mt.add("read", read_time)
+    mt.bytes_in = size
+    mt.cached = data is not None
+    opc_map = _worker["opc_map"]
+    new_data = None
+    if raw is None and data is None:
+        # left to the worker, which inflates it from the inherited mapping
+        with mt.stage("read"):
+            raw = _worker["zf"].read(fn)
+    if data is not None:
+        co = unpacker.load_pyc_data(data, opc_map, mt)
+    elif _worker["keep_stream"]:
+        new_data = unpacker.decrypt_pyc(fn, raw, None, mt)
+        co = unpacker.load_pyc_data(new_data, opc_map, mt)
+    else:
+        co = unpacker.load_pyc_data(unpacker.decrypt_pyc(fn, raw, opc_map, mt),
+                                    None, mt)
+
+    stdlib_fn = None
+    digest = None
+    with mt.stage("fingerprint"):
+        if _worker["stdlib"] is not None:
+            stdlib_fn = _worker["stdlib"].lookup(co)
+        if stdlib_fn is None and _worker["dedup"] != "none":
+            digest = fingerprint.code_hash(co)
+    return mt, co, new_data, digest, stdlib_fn
+
+
+def deparse_member(co, split=False, fallback=True):
+    start = time.perf_counter()
+    if _worker.get("emit") == "dis":
+        return (True, unpacker.disassemble_co_object(co).encode("utf-8"),
+                time.perf_counter() - start, None)
+    res = None
+    sm = splitdeparse.SplitModule.create(co) if split else None
+    if sm is not None:
+        res = sm.join([unpacker.decompile_co_object(x) for x in sm.codes()])
+    if res is None:
+        res = unpacker.decompile_co_object(co)
+    ok, src = res
+    coverage = None
+    if not ok and fallback and _worker.get("fallback") is not None:
+        partial = deparse_partial(co)
+        if partial is not None:
+            src, coverage = partial
+    return ok, src.encode("utf-8"), time.perf_counter() - start, coverage
+
+
+def deparse_partial(co):
+    # the fallback for modules that can't be decompiled as a whole; returns
+    # the source and the number of code objects decompiled out of the total,
+    # or None if the fallback itself fails
+    deparse = splitdeparse.budgeted(unpacker.decompile_co_object,
+                                    _worker["fallback"])
+    try:
+        src, done, total = splitdeparse.deparse_partial(co, deparse)
+    except Exception as e:
+        logger.warning("decompiling %s definition by definition failed "
+                       "(%s)" % (co.co_filename, str(e)))
+        return None
+    return src, (done, total)
+
+
+def _pool_load_member(item):
+    # code objects can't be pickled so they travel as marshal data; errors
+    # are returned instead of raised to keep the name of the member
+    try:
+        mt, co, new_data, digest, stdlib_fn = load_member(*item)
+    except Exception as e:
+        return item[0], e, None
+    if new_data is not None:
+        new_data = bytes(new_data)
+    return item[0], None, (mt, marshal.dumps(co), new_data, digest,
+                           stdlib_fn)
+
+
+def _pool_deparse_member(data, fallback=True):
+    return deparse_member(marshal.loads(data), False, fallback)
+
+
+def _pool_deparse_partial(data):
+    start = time.perf_counter()
+    co = marshal.loads(data)
+    partial = deparse_partial(co)
+    if partial is None:
+        _, src = unpacker.decompile_co_object(co)
+        return False, src.encode("utf-8"), time.perf_counter() - start, None
+    src, coverage = partial
+    return False, src.encode("utf-8"), time.perf_counter() - start, coverage
+
+
+class Pipeline:
+    def __init__(self, opc_map, zf, outdir, cache=None, trace=None,
+                 profile=None, dedup="copy", stdlib=None,
+                 stdlib_action="copy", jobs=1, read_depth=16,
+                 write_depth=16, split_threshold=0, fallback=None,
+                 emit="source", selected=None):
+        self.opc_map = opc_map
+        self.zf = zf
+        self.outdir = outdir
+        self.cache = cache
+        self.trace = trace or stagetrace.PipelineTrace()
+        self.profile = profile or profiler.ProfileSession(None)
+        if jobs > 1 and (self.profile.globs or self.profile.slowest):
+            raise Exception("profiling is not supported with more than one "
+                            "job")
+        self.dedup = dedup
+        self.stdlib = stdlib
+        self.stdlib_action = stdlib_action
+        self.jobs = jobs
+        self.split_threshold = split_threshold
+        # time budget per definition for decompiling the modules that fail as
+        # a whole definition by definition, None disables this
+        self.fallback = fallback
+        # source to decompile, dis to only write the disassembly
+        self.emit = emit
+        # the pyc files to process, all of them if None
+        self.selected = selected
+        # with a mapped zip the workers read the members themselves instead of
+        # getting them pickled from the reader thread
+        self.defer_read = jobs > 1 and isinstance(zf, mmapzip.MappedZipFile)
+        self.read_queue = BoundedQueue("read", read_depth)
+        self.write_queue = BoundedQueue("write", write_depth)
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        # content hash -> [output file of the first member with that hash,
+        # deparse time (None while it's still being decompiled), decompiled
+        # ok, duplicates waiting for the output]
+        self.seen = {}
+        self.processed = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.saved = 0.0
+        self.stdlib_matches = 0
+        self.partial = 0
+        self.partial_done = 0
+        self.partial_total = 0
+        # the members whose output was written without errors
+        self.done = set()
+
+    def reader(self, fns):
+        try:
+            for fn in fns:
+                if self.stop.is_set():
+                    break
+                start = time.perf_counter()
+                info = self.zf.getinfo(fn)
+                data = None
+                raw = None
+                if self.cache is not None:
+                    data = self.cache.get(info)
+                if data is None and not self.defer_read:
+                    raw = self.zf.read(info)
+                self.read_queue.put((fn, info.file_size, raw, data,
+                                     time.perf_counter() - start))
+        except Exception as e:
+            logger.error("Exception %s occured while reading the zip" %
+                         str(e))
+        finally:
+            self.read_queue.put(_STOP)
+
+    def writer(self):
+        while True:
+            item = self.write_queue.get()
+            if item is _STOP:
+                break
+            mt, action = item
+            try:
+                if action is not None:
+                    with mt.stage("write"):
+                        self._write(*action)
+            except Exception as e:
+                mt.ok = False
+                logger.error("Exception %s occured while writing %s" %
+                             (str(e), action[1]))
+            if mt.ok:
+                self.done.add(mt.fn)
+            self.trace.finish(mt)
+
+    def _write(self, kind, outfn, arg):
+        os.makedirs(os.path.dirname(outfn), exist_ok=True)
+        if kind == "data":
+            with open(outfn, "wb") as outfd:
+                outfd.write(arg)
+        elif kind == "copy":
+            shutil.copyfile(arg, outfn)
+        elif kind == "replicate":
+            unpacker.replicate_output(arg, outfn, self.dedup)
+
+    def outfn(self, fn):
+        if self.emit == "dis":
+            return os.path.join(self.outdir, fn[:-4] + ".dis")
+        return os.path.join(self.outdir, fn[:-1])
+
+    def loaded(self, mt, new_data, digest, stdlib_fn):
+        # decides what to do with a loaded member; returns True if it has to
+        # be decompiled
+        fn = mt.fn
+        outfn = self.outfn(fn)
+        if new_data is not None and self.cache is not None:
+            self.cache.put(self.zf.getinfo(fn), new_data)
+
+        if stdlib_fn is not None:
+            logger.info("%s is identical to Lib/%s of the stdlib, not "
+                        "decompiling it" % (fn, stdlib_fn))
+            mt.stdlib_match = stdlib_fn
+            mt.ok = True
+            self.stdlib_matches += 1
+            src = os.path.join(self.stdlib.libdir, stdlib_fn)
+            if self.stdlib_action == "copy" and self.emit == "source":
+                action = ("copy", outfn, src)
+            else:
+                action = ("data", outfn, ("# identical to Lib/%s of the "
+                                          "CPython stdlib\n" %
+                                          stdlib_fn).encode("utf-8"))
+            self.write_queue.put((mt, action))
+            return False
+
+        if digest is None:
+            return True
+        with self.lock:
+            entry = self.seen.get(digest)
+            if entry is None:
+                self.seen[digest] = [outfn, None, None, []]
+                return True
+            mt.duplicate_of = entry[0]
+            self.duplicates += 1
+            logger.info("%s is identical to %s, not decompiling it again" %
+                        (outfn, entry[0]))
+            if entry[1] is None:
+                # the first one hasn't been decompiled yet
+                entry[3].append(mt)
+                return False
+        self._replicate(mt, entry)
+        return False
+
+    def _replicate(self, mt, entry):
+        mt.ok = entry[2]
+        with self.lock:
+            self.saved += entry[1]
+            if not mt.ok:
+                self.failed += 1
+        self.write_queue.put((mt, ("replicate", self.outfn(mt.fn),
+                                   entry[0])))
+
+    def deparsed(self, mt, digest, ok, res, deparse_time, coverage=None):
+        mt.add("deparse", deparse_time)
+        mt.ok = ok
+        mt.bytes_out = len(res)
+        mt.coverage = coverage
+        outfn = self.outfn(mt.fn)
+        if not ok and coverage is not None:
+            done, total = coverage
+            logger.warning("Failed to decompile %s as a whole, %d of %d code "
+                           "objects (%.1f%%) decompiled separately to %s" %
+                           (mt.fn, done, total, 100.0 * done / total, outfn))
+            with self.lock:
+                self.failed += 1
+                self.partial += 1
+                self.partial_done += done
+                self.partial_total += total
+        elif not ok:
+            logger.warning("Failed to decompile %s to %s" % (mt.fn, outfn))
+            with self.lock:
+                self.failed += 1
+        else:
+            logger.info("Successfully decompiled %s to %s" % (mt.fn, outfn))
+        self.write_queue.put((mt, ("data", outfn, res)))
+        if digest is None:
+            return
+        with self.lock:
+            entry = self.seen[digest]
+            entry[1] = deparse_time
+            entry[2] = ok
+            waiting = entry[3]
+            entry[3] = []
+        for dup in waiting:
+            self._replicate(dup, entry)
+
+    def split(self, mt):
+        # whether the member is big enough to deparse its top-level functions
+        # and classes separately
+        return (self.emit == "source" and
+                0 < self.split_threshold <= mt.bytes_in)
+
+    def members(self):
+        while True:
+            item = self.read_queue.get()
+            if item is _STOP:
+                return
+            self.processed += 1
+            logger.info("Decrypting, patching and decompiling %s" % item[0])
+            yield item
+
+    def failure(self, fn, e, digest=None):
+        waiting = []
+        with self.lock:
+            self.failed += 1
+            if digest is not None and digest in self.seen:
+                # the duplicates waiting for this member fail with it; later
+                # ones are decompiled themselves
+                waiting = self.seen.pop(digest)[3]
+                self.failed += len(waiting)
+        mt = stagetrace.MemberTrace(fn)
+        mt.ok = False
+        self.write_queue.put((mt, None))
+        for dup in waiting:
+            dup.ok = False
+            self.write_queue.put((dup, None))
+        logger.error("Exception %s occured" % str(e))
+        self.stop.set()
+
+    def run_serial(self):
+        _init_worker(self.opc_map, self.stdlib, self.dedup,
+                     self.cache is not None, self.fallback, self.emit)
+        for item in self.members():
+            fn = item[0]
+            digest = None
+            try:
+                with self.profile.member(fn):
+                    mt, co, new_data, digest, stdlib_fn = load_member(*item)
+                    if self.loaded(mt, new_data, digest, stdlib_fn):
+                        self.deparsed(mt, digest,
+                                      *deparse_member(co, self.split(mt)))
+            except Exception as e:
+                self.failure(fn, e, digest)
+                break
+
+    def run_parallel(self, pool):
+        # limit the number of members in flight as the pool would otherwise
+        # drain the read queue into its own unbounded task queue; a member
+        # is only released once its output has been queued for writing
+        limit = self.jobs * 2
+        inflight = threading.BoundedSemaphore(limit)
+
+        def acquire():
+            while not inflight.acquire(timeout=0.1):
+                if self.stop.is_set():
+                    return False
+            return True
+
+        def on_error(fn, digest=None):
+            def callback(e):
+                try:
+                    self.failure(fn, e, digest)
+                finally:
+                    inflight.release()
+            return callback
+
+        def on_deparsed(mt, digest):
+            def callback(result):
+                try:
+                    self.deparsed(mt, digest, *result)
+                except Exception as e:
+                    self.failure(mt.fn, e, digest)
+                finally:
+                    inflight.release()
+            return callback
+
+        def on_piece(mt, digest, data, sm, results, i):
+            # collects the deparsed parts of a split module and stitches them
+            # together once the last one is in; a part that raised is kept
+            # as its exception such that the member is released only once
+            def callback(result):
+                with self.lock:
+                    results[i] = result
+                    if None in results:
+                        return
+                try:
+                    errors = [x for x in results if isinstance(x, Exception)]
+                    res = None
+                    if errors:
+                        logger.debug("deparsing a part of %s failed (%s), "
+                                     "deparsing it as a whole" %
+                                     (mt.fn, str(errors[0])))
+                    else:
+                        res = sm.join([(x[0], x[1].decode("utf-8"))
+                                       for x in results])
+                    if res is None:
+                        pool.apply_async(_pool_deparse_member, (data,),
+                                         callback=on_deparsed(mt, digest),
+                                         error_callback=on_error(mt.fn,
+                                                                 digest))
+                        return
+                    if not res[0] and self.fallback is not None:
+                        pool.apply_async(_pool_deparse_partial, (data,),
+                                         callback=on_deparsed(mt, digest),
+                                         error_callback=on_error(mt.fn,
+                                                                 digest))
+                        return
+                    self.deparsed(mt, digest, res[0], res[1].encode("utf-8"),
+                                  sum(x[2] for x in results))
+                except Exception as e:
+                    self.failure(mt.fn, e, digest)
+                inflight.release()
+            return callback
+
+        def deparse(mt, digest, data):
+            sm = None
+            if self.split(mt):
+                sm = splitdeparse.SplitModule.create(marshal.loads(data))
+            if sm is None:
+                pool.apply_async(_pool_deparse_member, (data,),
+                                 callback=on_deparsed(mt, digest),
+                                 error_callback=on_error(mt.fn, digest))
+                return
+            logger.debug("deparsing %s in %d parts" %
+                         (mt.fn, len(sm.pieces) + 1))
+            codes = sm.codes()
+            results = [None] * len(codes)
+            for i, x in enumerate(codes):
+                pool.apply_async(_pool_deparse_member,
+                                 (marshal.dumps(x), False),
+                                 callback=on_piece(mt, digest, data, sm,
+                                                   results, i),
+                                 error_callback=on_piece(mt, digest, data, sm,
+                                                         results, i))
+
+        def on_loaded(result):
+            fn, e, result = result
+            digest = None
+            try:
+                if e is not None:
+                    self.failure(fn, e)
+                else:
+                    mt, data, new_data, digest, stdlib_fn = result
+                    if self.loaded(mt, new_data, digest, stdlib_fn):
+                        deparse(mt, digest, data)
+                        return
+            except Exception as e:
+                self.failure(fn, e, digest)
+            inflight.release()
+
+        for item in self.members():
+            if not acquire():
+                break
+            pool.apply_async(_pool_load_member, (item,), callback=on_loaded,
+                             error_callback=on_error(item[0]))
+        # wait for the members still in flight
+        for _ in range(limit):
+            if not acquire():
+                return
+        pool.close()
+        pool.join()
+
+    def run(self):
+        fns = [x for x in self.zf.namelist() if x[-3:] == "pyc"]
+        if self.selected is not None:
+            fns = [x for x in fns if x in self.selected]
+        self.profile.expect(len(fns))
+        # the workers are forked before any of the threads are started as a
+        # lock held by one of those would stay locked forever in the workers
+        pool = None
+        if self.jobs > 1:
+            pool = multiprocessing.Pool(self.jobs, _init_worker,
+                                        (self.opc_map, self.stdlib,
+                                         self.dedup, self.cache is not None,
+                                         self.fallback, self.emit,
+                                         self.zf if self.defer_read else None))
+        reader = threading.Thread(target=self.reader, args=(fns,),
+                                  name="reader", daemon=True)
+        writer = threading.Thread(target=self.writer, name="writer",
+                                  daemon=True)
+        reader.start()
+        writer.start()
+        try:
+            if pool is not None:
+                self.run_parallel(pool)
+            else:
+                self.run_serial()
+        finally:
+            if pool is not None:
+                pool.terminate()
+            self.stop.set()
+            # unblock the reader if it is waiting for room in the queue
+            while reader.is_alive():
+                try:
+                    self.read_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.write_queue.put(_STOP)
+            writer.join()
+
+        self.read_queue.report()
+        self.write_queue.report()
+        logger.info("Processed %d files (%d succesfully decompiled, %d "
+                    "failed)" % (self.processed,
+                                 self.processed - self.failed, self.failed))
+        if self.stdlib_matches:
+            logger.info("%d of %d files (%.1f%%) were unmodified stdlib "
+                        "modules" % (self.stdlib_matches, self.processed,
+                                     100.0 * self.stdlib_matches /
+                                     self.processed))
+        if self.duplicates:
+            logger.info("%d of %d files (%.1f%%) were duplicates of other "
+                        "files, saving %.1fs of decompilation" %
+                        (self.duplicates, self.processed,
+                         100.0 * self.duplicates / self.processed,
+                         self.saved))
+        if self.partial:
+            logger.info("%d of the %d failed files were decompiled partially, "
+                        "%d of their %d code objects (%.1f%%) were recovered" %
+                        (self.partial, self.failed, self.partial_done,
+                         self.partial_total,
+                         100.0 * self.partial_done / self.partial_total))
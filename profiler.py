@@ -0,0 +1,174 @@
+import contextlib
+import fnmatch
+import heapq
+import itertools
+import logging
+import math
+import os
+import signal
+import sys
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Both profilers produce collapsed stacks: one line per unique call stack
+# with the frames separated by semicolons followed by a weight, which is the
+# input format of flamegraph.pl, speedscope and most other flame graph tools.
+
+
+def _frame_name(co):
+    return "%s (%s:%d)" % (co.co_name.replace(";", ":"),
+                           os.path.basename(co.co_filename),
+                           co.co_firstlineno)
+
+
+class SamplingProfiler:
+    # samples the Python stack of the main thread every interval seconds of
+    # CPU time; the weight of a stack is its number of samples
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.stacks = {}
+        self._old_handler = None
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append(_frame_name(frame.f_code))
+            frame = frame.f_back
+        key = ";".join(reversed(stack))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def __enter__(self):
+        self._old_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        return self
+
+    def __exit__(self, extype, exvalue, traceback):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._old_handler)
+
+
+class TracingProfiler:
+    # deterministic profiler that attributes the time between two profiling
+    # events to the stack at that moment; the weight is in microseconds
+    def __init__(self):
+        self.stacks = {}
+        self._stack = []
+        self._last = 0.0
+
+    def _account(self):
+        now = time.perf_counter()
+        if self._stack:
+            key = ";".join(self._stack)
+            self.stacks[key] = self.stacks.get(key, 0) + \
+                int((now - self._last) * 1e6)
+        self._last = now
+
+    def _event(self, frame, event, arg):
+        self._account()
+        if event == "call":
+            self._stack.append(_frame_name(frame.f_code))
+        elif event == "c_call":
+            self._stack.append("%s (builtin)" % getattr(arg, "__qualname__",
+                                                        str(arg)))
+        elif self._stack:
+            # return, c_return and c_exception
+            self._stack.pop()
+
+    def __enter__(self):
+        self._last = time.perf_counter()
+        sys.setprofile(self._event)
+        return self
+
+    def __exit__(self, extype, exvalue, traceback):
+        sys.setprofile(None)
+        self._account()
+
+
+def write_collapsed(fn, stacks):
+    with open(fn, "w") as fd:
+        for key, weight in sorted(stacks.items()):
+            if weight:
+                fd.write("%s %d\n" % (key, weight))
+
+
+class ProfileSession:
+    # profiles the members matching one of the globs and/or the slowest
+    # percentage of all members and writes a collapsed stack file per member
+    # to outdir. Picking the slowest members means that every member has to
+    # be profiled, which is only cheap enough with the sampling profiler.
+    def __init__(self, outdir, globs=(), slowest=None, mode="sampling",
+                 interval=0.001):
+        self.outdir = outdir
+        self.globs = list(globs or [])
+        self.slowest = slowest
+        self.mode = mode
+        self.interval = interval
+        # min-heap of the slowest members seen so far, at most keep of them
+        # once the number of members is known
+        self.candidates = []
+        self.keep = None
+        self._order = itertools.count()
+        self.written = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, extype, exvalue, traceback):
+        self.close()
+
+    def expect(self, count):
+        # the number of members that will be profiled, which bounds the
+        # number of profiles kept for picking the slowest ones
+        if self.slowest:
+            self.keep = int(math.ceil(count * self.slowest / 100.0))
+
+    def matches(self, fn):
+        return any(fnmatch.fnmatch(fn, x) for x in self.globs)
+
+    def _profiler(self):
+        if self.mode == "deterministic":
+            return TracingProfiler()
+        return SamplingProfiler(self.interval)
+
+    def _write(self, fn, prof):
+        outfn = os.path.join(self.outdir, fn + ".collapsed")
+        os.makedirs(os.path.dirname(outfn), exist_ok=True)
+        write_collapsed(outfn, prof.stacks)
+        self.written.add(fn)
+        logger.info("wrote profile of %s to %s" % (fn, outfn))
+
+    @contextlib.contextmanager
+    def member(self, fn):
+        if not self.matches(fn) and not self.slowest:
+            yield
+            return
+        prof = self._profiler()
+        start = time.perf_counter()
+        try:
+            with prof:
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if self.matches(fn):
+                self._write(fn, prof)
+            if self.slowest:
+                heapq.heappush(self.candidates,
+                               (elapsed, next(self._order), fn, prof))
+                if self.keep is not None and \
+                        len(self.candidates) > self.keep:
+                    heapq.heappop(self.candidates)
+
+    def close(self):
+        if not self.candidates:
+            return
+        n = int(math.ceil(len(self.candidates) * self.slowest / 100.0))
+        if self.keep is not None:
+            n = self.keep
+        for elapsed, _, fn, prof in heapq.nlargest(n, self.candidates):
+            logger.info("%s is among the slowest members (%.2fs)" %
+                        (fn, elapsed))
+            if fn not in self.written:
+                self._write(fn, prof)
+        self.candidates = []
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import logging
+import os
+import struct
+import sys
+import zipfile
+
+import opcodemap
+
+if sys.version_info[0] < 3:
+    raise Exception("This module is Python 3 only")
+
+logger = logging.getLogger(__name__)
+
+# number of members that are sampled for the fingerprint of a zip; this only
+# touches the central directory so it doesn't require decompressing anything
+# besides the first few bytes of the first pyc to get at its magic
+FINGERPRINT_SAMPLE = 32
+
+
+def fingerprint_zipfile(zf):
+    infos = sorted([x for x in zf.infolist() if x.filename[-3:] == "pyc"],
+                   key=lambda x: x.filename)
+    if not infos:
+        raise Exception("no pyc files found in zipfile")
+    with zf.open(infos[0], "r") as f:
+        magic = f.read(4)
+
+    step = max(1, len(infos) // FINGERPRINT_SAMPLE)
+    h = hashlib.sha256()
+    for info in infos[::step][:FINGERPRINT_SAMPLE]:
+        h.update(info.filename.encode("utf-8"))
+        h.update(struct.pack("<LL", info.CRC, info.file_size))
+    return "%s-%s" % (magic.hex(), h.hexdigest()[:32])
+
+
+def registry_path(regdir, fp, partial=False):
+    # maps from a partial gendb run are kept apart from the real ones such
+    # that they are never taken for a complete map
+    return os.path.join(regdir, "%s%s.db" % (fp, ".partial" if partial
+                                             else ""))
+
+
+def lookup(regdir, fp, partial=False):
+    fn = registry_path(regdir, fp, partial)
+    if os.path.exists(fn):
+        return fn
+    return None
+
+
+def register(regdir, fp, db):
+    os.makedirs(regdir, exist_ok=True)
+    fn = registry_path(regdir, fp)
+    with opcodemap.OpcodeMapping(db, False) as opc_map:
+        if not opc_map.loaded_from_fs:
+            raise Exception("cannot load opcode db %s" % db)
+        opc_map.write(fn)
+    logger.info("registered %s as %s" % (db, fn))
+    partial = lookup(regdir, fp, True)
+    if partial is not None:
+        os.remove(partial)
+        logger.info("removed the partial map %s" % partial)
+    return fn
+
+
+def generate_partial(regdir, fp, zf, zipfn, pydir, limit):
+    # lazily import gendb as it imports the unpacker module itself
+    import gendb
+
+    # an existing partial map is extended with up to limit more files
+    os.makedirs(regdir, exist_ok=True)
+    fn = registry_path(regdir, fp, True)
+    logger.warning("no opcode map registered for %s, running a partial gendb "
+                   "over at most %d more files into %s; register the map of "
+                   "a full gendb run to stop this" % (fp, limit, fn))
+    zip_hash = opcodemap.zip_sha256(zipfn)
+    with opcodemap.OpcodeMapping(fn, True) as opc_map:
+        opc_map.zip_hash = zip_hash
+        gendb.generate_opcode_mapping_from_zipfile(opc_map, zf,
+                                                   os.path.join(pydir, "Lib"),
+                                                   limit)
+    return fn
+
+
+if __name__ == "__main__":
+
+    root = logging.getLogger()
+    root.setLevel(logging.WARNING)
+    logger.setLevel(logging.DEBUG)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    root.addHandler(handler)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--registry", default="registry",
+                        help="directory holding the opcode maps indexed by "
+                             "zip fingerprint")
+    parser.add_argument("--dropbox-zip",
+                        help="zipfile containing the dropbox obfuscated code")
+    parser.add_argument("--db",
+                        help="opcode database file to register for the zip")
+    parser.add_argument("--list", action="store_true",
+                        help="list the registered opcode maps")
+    ns = parser.parse_args()
+
+    if ns.list:
+        for fn in sorted(os.listdir(ns.registry)):
+            if fn[-3:] != ".db":
+                continue
+            with opcodemap.OpcodeMapping(os.path.join(ns.registry, fn),
+                                         False) as opc_map:
+                print("%s dropbox=%s mapped=%d%s" %
+                      (fn[:-3], opc_map.dropbox_version or "unknown",
+                       len(opc_map.table),
+                       " (partial)" if fn.endswith(".partial.db") else ""))
+        sys.exit(0)
+
+    if not ns.dropbox_zip:
+        parser.error("--dropbox-zip is required")
+
+    with zipfile.PyZipFile(ns.dropbox_zip, "r", zipfile.ZIP_DEFLATED) as zf:
+        fp = fingerprint_zipfile(zf)
+    print("fingerprint: %s" % fp)
+    if ns.db:
+        register(ns.registry, fp, ns.db)
+    else:
+        print("registered: %s" % (lookup(ns.registry, fp) or "no"))
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import difflib
+import json
+import logging
+import os
+import sys
+import time
+import types
+
+import fingerprint
+import membercache
+import mmapzip
+import opcodemap
+import registry
+import splitdeparse
+import unpacker
+
+if sys.version_info[0] < 3:
+    raise Exception("This module is Python 3 only")
+
+logger = logging.getLogger(__name__)
+
+# Compares two Dropbox releases at the bytecode level. Every function, class
+# and module body of both zips is hashed over its remapped code, constants and
+# names (see fingerprint.definition_hash) and keyed by the module and its
+# dotted path in there, so the comparison costs about as much as loading the
+# zips. Only the definitions that changed are decompiled afterwards.
+
+
+def definitions(co):
+    # maps the dotted path of every function and class in a module (and
+    # <module> for the module body) to its code object; definitions that
+    # share a path (conditional ones for example) get a #n suffix
+    defs = {}
+    todo = [(co, "<module>")]
+    while todo:
+        co, path = todo.pop()
+        name = path
+        n = 1
+        while name in defs:
+            n += 1
+            name = "%s#%d" % (path, n)
+        defs[name] = co
+        prefix = "" if co.co_name == "<module>" else path + "."
+        nested = [x for x in co.co_consts if isinstance(x, types.CodeType)]
+        while nested:
+            x = nested.pop()
+            if x.co_name[:1] == "<":
+                nested.extend(y for y in x.co_consts
+                              if isinstance(y, types.CodeType))
+            else:
+                todo.append((x, prefix + x.co_name))
+    return defs
+
+
+def hash_zipfile(zf, opc_map, cache=None):
+    # pyc file -> {definition path -> hash} for all the pyc files in zf
+    modules = {}
+    for fn in zf.namelist():
+        if fn[-3:] != "pyc":
+            continue
+        try:
+            co = unpacker.load_pyc(zf, fn, opc_map, cache)
+        except Exception as e:
+            logger.error("cannot load %s (%s), leaving it out" % (fn, str(e)))
+            continue
+        modules[fn] = dict(
+            (path, fingerprint.definition_hash(x))
+            for path, x in definitions(co).items())
+    return modules
+
+
+def compare(old, new):
+    report = {
+        "modules": {"added": [], "removed": []},
+        "definitions": {"added": [], "removed": [], "changed": []},
+    }
+    for mod in sorted(set(old) | set(new)):
+        if mod not in old:
+            report["modules"]["added"].append(mod)
+            continue
+        if mod not in new:
+            report["modules"]["removed"].append(mod)
+            continue
+        old_defs = old[mod]
+        new_defs = new[mod]
+        for path in sorted(set(old_defs) | set(new_defs)):
+            name = "%s:%s" % (mod, path)
+            if path not in old_defs:
+                report["definitions"]["added"].append(name)
+            elif path not in new_defs:
+                report["definitions"]["removed"].append(name)
+            elif old_defs[path] != new_defs[path]:
+                report["definitions"]["changed"].append(name)
+    return report
+
+
+def decompile_changes(report, old, new, outdir, cache=None, budget=None):
+    # writes a unified diff of the decompiled old and new version of every
+    # changed definition to a .diff file per module; old and new are the
+    # zipfile and opcode map of either release
+    deparse = splitdeparse.budgeted(unpacker.decompile_co_object, budget)
+    changed = {}
+    for name in report["definitions"]["changed"]:
+        fn, path = name.split(":", 1)
+        changed.setdefault(fn, []).append(path)
+
+    for fn, paths in sorted(changed.items()):
+        old_defs = definitions(unpacker.load_pyc(old[0], fn, old[1], cache))
+        new_defs = definitions(unpacker.load_pyc(new[0], fn, new[1], cache))
+        lines = []
+        for path in paths:
+            _, old_src = splitdeparse.deparse_definition(old_defs[path],
+                                                         deparse)
+            _, new_src = splitdeparse.deparse_definition(new_defs[path],
+                                                         deparse)
+            lines.extend(difflib.unified_diff(
+                old_src.strip("\n").splitlines(True),
+                new_src.strip("\n").splitlines(True),
+                "a/%s:%s" % (fn[:-1], path), "b/%s:%s" % (fn[:-1], path)))
+            lines.append("\n")
+        outfn = os.path.join(outdir, fn[:-4] + ".diff")
+        os.makedirs(os.path.dirname(outfn), exist_ok=True)
+        with open(outfn, "w") as fd:
+            fd.write("".join(x if x.endswith("\n") else x + "\n"
+                             for x in lines))
+        logger.info("wrote %d changed definitions of %s to %s" %
+                    (len(paths), fn, outfn))
+
+
+def select_db(zf, db, regdir):
+    if db:
+        return db
+    fp = registry.fingerprint_zipfile(zf)
+    db = registry.lookup(regdir, fp)
+    if db is None:
+        raise Exception("no opcode map registered for fingerprint %s" % fp)
+    logger.info("using opcode map %s for fingerprint %s" % (db, fp))
+    return db
+
+
+if __name__ == "__main__":
+
+    root = logging.getLogger()
+    root.setLevel(logging.WARNING)
+    logger.setLevel(logging.DEBUG)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    root.addHandler(handler)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--old-zip", required=True,
+                        help="zipfile of the old Dropbox release")
+    parser.add_argument("--new-zip", required=True,
+                        help="zipfile of the new Dropbox release")
+    parser.add_argument("--old-db",
+                        help="opcode database of the old release (selected "
+                             "from the registry by zip fingerprint if not "
+                             "given)")
+    parser.add_argument("--new-db",
+                        help="opcode database of the new release (selected "
+                             "from the registry by zip fingerprint if not "
+                             "given)")
+    parser.add_argument("--registry", default="registry",
+                        help="directory holding the opcode maps indexed by "
+                             "zip fingerprint")
+    parser.add_argument("--cache",
+                        help="member cache file with decrypted marshal "
+                             "streams (created if it doesn't exist)")
+    parser.add_argument("--report", default="diff.json",
+                        help="output file for the added, removed and "
+                             "changed modules and definitions")
+    parser.add_argument("--output-dir", default="./diff",
+                        help="output dir for the diffs of the decompiled "
+                             "changed definitions")
+    parser.add_argument("--no-decompile", action="store_true",
+                        help="only write the report")
+    parser.add_argument("--budget", type=float, default=30,
+                        help="seconds after which decompiling a single "
+                             "definition is given up (0 for no limit)")
+    ns = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        old_zf = stack.enter_context(mmapzip.open_zipfile(ns.old_zip))
+        new_zf = stack.enter_context(mmapzip.open_zipfile(ns.new_zip))
+        old_map = stack.enter_context(opcodemap.OpcodeMapping(
+            select_db(old_zf, ns.old_db, ns.registry), False))
+        new_map = stack.enter_context(opcodemap.OpcodeMapping(
+            select_db(new_zf, ns.new_db, ns.registry), False))
+        cache = None
+        if ns.cache:
+            cache = stack.enter_context(membercache.MemberCache(ns.cache))
+
+        start = time.perf_counter()
+        old = hash_zipfile(old_zf, old_map, cache)
+        new = hash_zipfile(new_zf, new_map, cache)
+        report = compare(old, new)
+        logger.info("compared %d and %d modules in %.2fs" %
+                    (len(old), len(new), time.perf_counter() - start))
+        report["old"] = ns.old_zip
+        report["new"] = ns.new_zip
+        with open(ns.report, "w") as fd:
+            json.dump(report, fd, indent=1, sort_keys=True)
+        for kind in ("modules", "definitions"):
+            logger.info("%s: %d added, %d removed%s" %
+                        (kind, len(report[kind]["added"]),
+                         len(report[kind]["removed"]),
+                         ", %d changed" % len(report[kind]["changed"])
+                         if "changed" in report[kind] else ""))
+
+        if not ns.no_decompile:
+            decompile_changes(report, (old_zf, old_map), (new_zf, new_map),
+                              ns.output_dir, cache, ns.budget)
@@ -0,0 +1,326 @@
+import dis
+import io
+import logging
+import re
+import signal
+import threading
+import types
+
+import stagetrace
+
+
+logger = logging.getLogger(__name__)
+
+# Deparsing a huge module is a single uncompyle6 call that can take longer
+# than the rest of the zip combined. To spread it over several workers the
+# top-level function and class bodies are cut out of the module: every one of
+# them is replaced by a stub whose body is a single marker name and is wrapped
+# in a tiny module of its own that only defines it. The stubbed module and the
+# wrapped bodies are deparsed independently and the bodies are put back in
+# place of the markers afterwards.
+#
+# The same is used when a module can't be decompiled at all: its definitions
+# are then decompiled one by one (recursing into the methods of classes that
+# fail) and whatever fails is replaced by its disassembly.
+
+CO_OPTIMIZED = 0x1
+CO_NEWLOCALS = 0x2
+CO_GENERATOR = 0x20
+CO_NOFREE = 0x40
+CO_COROUTINE = 0x80
+CO_ASYNC_GENERATOR = 0x200
+
+MARKER = "__lookinside_split_%d__"
+INDENT = "    "
+
+
+def _asm(*instrs):
+    code = bytearray()
+    for instr in instrs:
+        code.append(dis.opmap[instr[0]])
+        code.append(instr[1] if len(instr) > 1 else 0)
+    return bytes(code)
+
+
+def _module(code, consts, names, stacksize, firstlineno=1):
+    return types.CodeType(0, 0, 0, stacksize, CO_NOFREE, code, consts, names,
+                          (), "<split>", "<module>", firstlineno, b"", (), ())
+
+
+def _function_stub(co, marker):
+    # same signature as the function but a body that only evaluates the
+    # marker; without a yield in the body a generator flag would make
+    # uncompyle6 add one, so async generators become plain coroutines
+    flags = co.co_flags & ~(CO_GENERATOR | CO_ASYNC_GENERATOR)
+    if co.co_flags & CO_ASYNC_GENERATOR:
+        flags |= CO_COROUTINE
+    code = _asm(("LOAD_GLOBAL", 0), ("POP_TOP",), ("LOAD_CONST", 0),
+                ("RETURN_VALUE",))
+    return types.CodeType(co.co_argcount, co.co_kwonlyargcount,
+                          co.co_nlocals, 1, flags, code, (None,), (marker,),
+                          co.co_varnames, co.co_filename, co.co_name,
+                          co.co_firstlineno, b"", (), ())
+
+
+def _class_stub(co, marker):
+    code = _asm(("LOAD_NAME", 0), ("STORE_NAME", 1), ("LOAD_CONST", 0),
+                ("STORE_NAME", 2), ("LOAD_NAME", 3), ("POP_TOP",),
+                ("LOAD_CONST", 1), ("RETURN_VALUE",))
+    return types.CodeType(0, 0, 0, 1, CO_NOFREE, code, (co.co_name, None),
+                          ("__name__", "__module__", "__qualname__", marker),
+                          (), co.co_filename, co.co_name, co.co_firstlineno,
+                          b"", (), ())
+
+
+def _function_module(co):
+    code = _asm(("LOAD_CONST", 0), ("LOAD_CONST", 1), ("MAKE_FUNCTION", 0),
+                ("STORE_NAME", 0), ("LOAD_CONST", 2), ("RETURN_VALUE",))
+    return _module(code, (co, co.co_name, None), (co.co_name,), 2)
+
+
+def _class_module(co):
+    code = _asm(("LOAD_BUILD_CLASS",), ("LOAD_CONST", 0), ("LOAD_CONST", 1),
+                ("MAKE_FUNCTION", 0), ("LOAD_CONST", 1),
+                ("CALL_FUNCTION", 2), ("STORE_NAME", 0), ("LOAD_CONST", 2),
+                ("RETURN_VALUE",))
+    return _module(code, (co, co.co_name, None), (co.co_name,), 4)
+
+
+def _wrap(co):
+    if co.co_flags & CO_NEWLOCALS:
+        return _function_module(co)
+    return _class_module(co)
+
+
+def _stub(co, marker):
+    if co.co_flags & CO_NEWLOCALS:
+        return _function_stub(co, marker)
+    return _class_stub(co, marker)
+
+
+def _replace_consts(co, consts):
+    return types.CodeType(co.co_argcount, co.co_kwonlyargcount,
+                          co.co_nlocals, co.co_stacksize, co.co_flags,
+                          co.co_code, tuple(consts), co.co_names,
+                          co.co_varnames, co.co_filename, co.co_name,
+                          co.co_firstlineno, co.co_lnotab, co.co_freevars,
+                          co.co_cellvars)
+
+
+def _stub_definitions(co):
+    # returns co with its function and class definitions replaced by stubs
+    # and the (marker, code object) of every definition
+    consts = list(co.co_consts)
+    pieces = []
+    for i, x in enumerate(consts):
+        # lambdas and comprehensions are left in place
+        if not isinstance(x, types.CodeType) or x.co_name[:1] == "<":
+            continue
+        marker = MARKER % len(pieces)
+        consts[i] = _stub(x, marker)
+        pieces.append((marker, x))
+    return _replace_consts(co, consts), pieces
+
+
+def _declares_globals(co):
+    # uncompyle6 hands out module level global statements to the first
+    # function using the name, which a body deparsed on its own can't know
+    return any(x.opname in ("STORE_GLOBAL", "DELETE_GLOBAL")
+               for x in dis.get_instructions(co))
+
+
+def piece_body(src):
+    # the lines of the body of the only definition in a deparsed piece
+    lines = src.split("\n")
+    for i, line in enumerate(lines):
+        if line.startswith(("def ", "async def ", "class ")):
+            body = lines[i+1:]
+            while body and not body[-1].strip():
+                body.pop()
+            if all(x.startswith(INDENT) for x in body if x.strip()):
+                return body
+            return None
+    return None
+
+
+def stitch(src, bodies):
+    # replaces every marker line in the deparsed stub module by the body for
+    # that marker; returns None if the markers can't be found unambiguously
+    lines = src.split("\n")
+    where = {}
+    for i, line in enumerate(lines):
+        marker = line.strip()
+        if marker in bodies:
+            if marker in where:
+                return None
+            where[marker] = i
+    if len(where) != len(bodies):
+        return None
+    for marker, i in sorted(where.items(), key=lambda x: x[1], reverse=True):
+        body = bodies[marker]
+        if body is None:
+            return None
+        indent = lines[i][:len(lines[i]) - len(lines[i].lstrip())]
+        lines[i:i+1] = [indent + x[len(INDENT):] if x.strip() else ""
+                        for x in body]
+    return "\n".join(lines)
+
+
+class SplitModule:
+    def __init__(self, stub, pieces):
+        self.stub = stub
+        # (marker, wrapped body) for every split off definition
+        self.pieces = pieces
+
+    @classmethod
+    def create(cls, co):
+        # returns None if the module has nothing to split off or can't be
+        # split without changing the output
+        try:
+            if _declares_globals(co):
+                return None
+        except IndexError:
+            # bytecode dis can't even walk is left to the whole module
+            return None
+        stub, pieces = _stub_definitions(co)
+        if not pieces:
+            return None
+        return cls(stub, [(marker, _wrap(x)) for marker, x in pieces])
+
+    def codes(self):
+        # the code objects to deparse, the stubbed module first
+        return [self.stub] + [x[1] for x in self.pieces]
+
+    def join(self, results):
+        # combines the (ok, source) results for codes(); a failed piece fails
+        # the module and None means that the whole module has to be deparsed
+        for ok, res in results:
+            if not ok:
+                return ok, res
+        bodies = dict((marker, piece_body(res)) for (marker, _), (_, res) in
+                      zip(self.pieces, results[1:]))
+        src = stitch(results[0][1], bodies)
+        if src is None:
+            logger.debug("cannot stitch the split module back together")
+            return None
+        return True, src
+
+
+def deparse_definition(co, deparse):
+    # decompiles a single function or class, or the code of a module with
+    # every definition in it reduced to an ellipsis
+    if co.co_name != "<module>":
+        return deparse(_wrap(co))
+    stub, pieces = _stub_definitions(co)
+    ok, res = deparse(stub)
+    if ok:
+        res = stitch(res, dict((marker, [INDENT + "..."])
+                               for marker, _ in pieces)) or res
+    return ok, res
+
+
+class DeparseTimeout(Exception):
+    pass
+
+
+def _timeout(signum, frame):
+    raise DeparseTimeout("decompiling took longer than the time budget")
+
+
+def budgeted(deparse, budget):
+    # makes deparse give up after budget seconds. This relies on SIGALRM and
+    # therefore only works on the main thread of a process (the worker
+    # processes or the unpacker itself without --jobs).
+    if not budget or threading.current_thread() is not threading.main_thread():
+        return deparse
+
+    def wrapper(co):
+        previous = signal.signal(signal.SIGALRM, _timeout)
+        signal.setitimer(signal.ITIMER_REAL, budget)
+        try:
+            return deparse(co)
+        except DeparseTimeout as e:
+            return False, str(e)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+    return wrapper
+
+
+def _listing(co, reason, recursive):
+    out = io.StringIO()
+    if recursive:
+        dis.dis(co, file=out)
+    else:
+        out.write(dis.Bytecode(co).dis())
+    # without the addresses of the code objects to keep the output the same
+    # from run to run
+    listing = re.sub(r" at 0x[0-9a-f]+", "", out.getvalue())
+    return ["# " + reason] + [("# " + x).rstrip()
+                              for x in listing.splitlines()]
+
+
+def _reason(res):
+    lines = [x for x in res.splitlines() if x.strip()]
+    return "decompilation failed: %s" % (lines[-1] if lines else "")
+
+
+def _partial(co, deparse, in_class):
+    # returns the source lines of a module, or of a class body (without the
+    # class statement and indentation), and the number of code objects that
+    # were decompiled
+    stub, pieces = _stub_definitions(co)
+    done = 0
+    bodies = {}
+    for marker, x in pieces:
+        ok, res = deparse(_wrap(x))
+        body = piece_body(res) if ok else None
+        if body is not None:
+            done += stagetrace.count_code_objects(x)
+        elif x.co_flags & CO_NEWLOCALS:
+            body = [INDENT + y for y in
+                    _listing(x, _reason(res), True) + ["pass"]]
+        else:
+            lines, n = _partial(x, deparse, True)
+            body = [INDENT + y if y.strip() else "" for y in lines]
+            done += n
+        bodies[marker] = body
+
+    ok, res = deparse(_class_module(stub) if in_class else stub)
+    if ok and in_class:
+        lines = piece_body(res)
+        res = None
+        if lines is not None:
+            res = "\n".join(y[len(INDENT):] for y in lines)
+    src = stitch(res, bodies) if ok and res is not None else None
+    if src is not None:
+        done += stagetrace.count_code_objects(co) - sum(
+            stagetrace.count_code_objects(x) for _, x in pieces)
+        return src.split("\n"), done
+
+    # the code around the definitions failed: its disassembly goes first and
+    # the definitions follow with the headers from their stubs
+    parts = ["\n".join(_listing(co, _reason(res or ""), False))]
+    for marker, x in pieces:
+        ok, header = deparse(_wrap(_stub(x, marker)))
+        if not ok:
+            kind = "def %s():" if x.co_flags & CO_NEWLOCALS else "class %s:"
+            header = (kind % x.co_name) + "\n" + INDENT + marker
+        parts.append(header.strip("\n"))
+    if not in_class:
+        parts.append("")
+    src = stitch("\n\n\n".join(parts), bodies)
+    if src is None:
+        # the markers can't be found in the headers, so the definitions
+        # can't be put in place; all that is left is the whole disassembly
+        lines = _listing(co, _reason(res or ""), True)
+        return lines + ["pass"] if in_class else lines, 0
+    return src.split("\n"), done
+
+
+def deparse_partial(co, deparse):
+    # decompiles a module that can't be decompiled as a whole definition by
+    # definition; returns the source and the number of code objects that were
+    # decompiled out of the total
+    lines, done = _partial(co, deparse, False)
+    return "\n".join(lines), done, stagetrace.count_code_objects(co)
@@ -0,0 +1,127 @@
+import contextlib
+import json
+import logging
+import math
+import time
+import types
+
+
+logger = logging.getLogger(__name__)
+
+# stages every member goes through in the unpacker, in order
+STAGES = ("read", "keyderiv", "decrypt", "unmarshal", "remap", "fingerprint",
+          "deparse", "write")
+
+
+def count_code_objects(co):
+    return 1 + sum(count_code_objects(x) for x in co.co_consts
+                   if isinstance(x, types.CodeType))
+
+
+def percentile(values, pct):
+    # nearest-rank percentile of an already sorted list
+    if not values:
+        return 0.0
+    idx = max(0, min(len(values) - 1,
+                     math.ceil(pct * len(values) / 100.0) - 1))
+    return values[idx]
+
+
+class MemberTrace:
+    def __init__(self, fn):
+        self.fn = fn
+        self.times = dict((x, 0.0) for x in STAGES)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.code_objects = 0
+        self.cached = False
+        self.duplicate_of = None
+        self.stdlib_match = None
+        self.ok = None
+        # (decompiled, total) code objects of a module that was only
+        # decompiled partially
+        self.coverage = None
+
+    def add(self, stage, elapsed):
+        self.times[stage] = self.times.get(stage, 0.0) + elapsed
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def total(self):
+        return sum(self.times.values())
+
+    def to_dict(self):
+        return {
+            "file": self.fn,
+            "times": self.times,
+            "total": self.total(),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "code_objects": self.code_objects,
+            "cached": self.cached,
+            "duplicate_of": self.duplicate_of,
+            "stdlib_match": self.stdlib_match,
+            "ok": self.ok,
+            "coverage": self.coverage,
+        }
+
+
+class PipelineTrace:
+    # collects the member traces of a run, writes each of them as a line of
+    # JSON to fn (if given) and summarizes them at the end
+    def __init__(self, fn=None):
+        self.fn = fn
+        self.members = []
+        self._fd = None
+
+    def __enter__(self):
+        if self.fn:
+            self._fd = open(self.fn, "w")
+        return self
+
+    def __exit__(self, extype, exvalue, traceback):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+        if self.members:
+            for line in self.summary().splitlines():
+                logger.info(line)
+
+    def member(self, fn):
+        return MemberTrace(fn)
+
+    def finish(self, mt):
+        self.members.append(mt)
+        if self._fd is not None:
+            self._fd.write(json.dumps(mt.to_dict(), sort_keys=True) + "\n")
+
+    def summary(self):
+        lines = ["%-11s %10s %10s %10s %10s %6s" %
+                 ("stage", "p50 ms", "p95 ms", "max ms", "total s", "share")]
+        grand_total = sum(x.total() for x in self.members) or 1.0
+        for stage in STAGES + ("total",):
+            if stage == "total":
+                values = sorted(x.total() for x in self.members)
+            else:
+                values = sorted(x.times.get(stage, 0.0)
+                                for x in self.members)
+            total = sum(values)
+            lines.append("%-11s %10.2f %10.2f %10.2f %10.2f %5.1f%%" %
+                         (stage, percentile(values, 50) * 1e3,
+                          percentile(values, 95) * 1e3, values[-1] * 1e3,
+                          total, 100.0 * total / grand_total))
+        bytes_in = sum(x.bytes_in for x in self.members)
+        bytes_out = sum(x.bytes_out for x in self.members)
+        lines.append("%d members, %d code objects, %.2f MB in, %.2f MB out, "
+                     "%.2f MB/s" %
+                     (len(self.members),
+                      sum(x.code_objects for x in self.members),
+                      bytes_in / 1e6, bytes_out / 1e6,
+                      bytes_in / 1e6 / grand_total))
+        return "\n".join(lines)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_script(script, *args, returncode=0):
+    proc = subprocess.run([sys.executable, os.path.join(HERE, script)] +
+                          list(args), stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, cwd=HERE)
+    output = proc.stdout.decode("utf-8", "replace")
+    if proc.returncode != returncode:
+        raise Exception("%s exited with %d:\n%s" %
+                        (script, proc.returncode, output))
+    return output
+
+
+class UnpackerCLITest(unittest.TestCase):
+    # runs the unpacker on a small synthetic corpus and checks what it prints
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.zipfn = os.path.join(cls.tmpdir.name, "corpus.zip")
+        cls.dbfn = os.path.join(cls.tmpdir.name, "corpus.db")
+        run_script("gencorpus.py", "--output-zip", cls.zipfn, "--db",
+                   cls.dbfn, "--seed", "1", "--max-files", "3")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def unpack(self, *args, returncode=0):
+        outdir = os.path.join(self.tmpdir.name, "out")
+        return run_script("unpacker.py", "--dropbox-zip", self.zipfn,
+                          "--db", self.dbfn, "--output-dir", outdir, *args,
+                          returncode=returncode)
+
+    def test_summary(self):
+        output = self.unpack()
+        self.assertIn("Decrypting, patching and decompiling", output)
+        self.assertIn("Processed 3 files", output)
+        self.assertIn("queue: ", output)
+
+    def test_trace_summary(self):
+        output = self.unpack("--trace",
+                             os.path.join(self.tmpdir.name, "trace.jsonl"))
+        self.assertIn("p50 ms", output)
+        self.assertIn("3 members", output)
+
+    def test_validate(self):
+        output = self.unpack("--validate")
+        self.assertIn("validated ", output)
+
+    def test_member_cache(self):
+        cachefn = os.path.join(self.tmpdir.name, "members.cache")
+        self.unpack("--cache", cachefn)
+        output = self.unpack("--cache", cachefn)
+        self.assertIn("member cache: 3 hits, 0 misses", output)
+
+    def test_profile(self):
+        output = self.unpack("--profile", "*", "--profile-dir",
+                             os.path.join(self.tmpdir.name, "profile"))
+        self.assertIn("wrote profile of ", output)
+
+    def test_profile_slowest(self):
+        output = self.unpack("--profile-slowest", "50", "--profile-dir",
+                             os.path.join(self.tmpdir.name, "slowest"))
+        self.assertEqual(output.count("is among the slowest members"), 2)
+
+    def test_profile_with_jobs(self):
+        output = self.unpack("--profile-slowest", "50", "--jobs", "2",
+                             returncode=2)
+        self.assertIn("only work with --jobs 1", output)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -378,6 +378,11 @@ class Unmarshaller:
 
         self.dispatch = dispatch
         self._opcode_mapping = None
+        # optional callbacks applied to the fields of every code object
+        # before it is created: code_transform(co_code) and
+        # consts_transform(co_consts, co_filename, co_firstlineno)
+        self.code_transform = None
+        self.consts_transform = None
         self.depth = 0
         self.refs = []
         self.flags = []
@@ -394,36 +399,26 @@ class Unmarshaller:
         return self.r_object()
 
     def r_long64(self):
-        a = ord(self._read(1))
-        b = ord(self._read(1))
-        c = ord(self._read(1))
-        d = ord(self._read(1))
-        e = ord(self._read(1))
-        f = ord(self._read(1))
-        g = ord(self._read(1))
-        h = ord(self._read(1))
-        x = a | (b << 8) | (c << 16) | (d << 24)
-        x = x | (e << 32) | (f << 40) | (g << 48) | (h << 56)
-        if h & 0x80 and x > 0:
-            x = -((1 << 64) - x)
-        return x
+        return int.from_bytes(self._read(8), "little", signed=True)
 
+    # the debug messages below are formatted lazily as they're hit for every
+    # object and str() of a large int constant can even raise
     def r_ref_reserve(self):
         if self.flags[-1]:
             lr = len(self.refs)
             if lr > SIZE32_MAX-1:
                 raise Exception("bad marshal data (index list too large)")
             self.refs.append(None)
-            logger.debug("reserved reference with idx %d" % lr)
+            logger.debug("reserved reference with idx %d", lr)
             return lr
         return 0
 
     def r_ref_insert(self, idx, obj):
         if self.flags[-1]:
             bef = self.refs[idx]
-            logger.debug("inserted reference at idx %d" % idx)
-            logger.debug("reference at idx %d before: %s and after: %s" %
-                         (idx, bef, obj))
+            logger.debug("inserted reference at idx %d", idx)
+            logger.debug("reference at idx %d before: %s and after: %s",
+                         idx, bef, obj)
             self.refs[idx] = obj
             return self.refs[idx]
 
@@ -431,28 +426,17 @@ class Unmarshaller:
         return self._read(1)
 
     def r_short(self):
-        a, b = tuple(self._read(2))
-        x = a | (b << 8)
-        # sign extension in case short greater than 16 bits
-        # XXX double check
-        x |= -(x & 0x80000)
-        return x
+        return int.from_bytes(self._read(2), "little")
 
     def r_long(self):
-        a, b, c, d = tuple(self._read(4))
-        x = a | (b << 8) | (c << 16) | (d << 24)
-        if d & 0x80 and x > 0:
-            x = -((1 << 32) - x)
-            return int(x)
-        else:
-            return x
+        return int.from_bytes(self._read(4), "little", signed=True)
 
     def r_ref(self, obj):
         if self.flags[-1] == 0:
-            logger.debug("not adding reference to object %s" % (obj,))
+            logger.debug("not adding reference to object %s", obj)
             return obj
-        logger.debug("adding reference %d to object %s" %
-                     (len(self.refs), obj))
+        logger.debug("adding reference %d to object %s", len(self.refs),
+                     obj)
         self.refs.append(obj)
         return obj
 
@@ -469,8 +453,8 @@ class Unmarshaller:
 
         try:
             fn, _type = self.dispatch[co_type]
-            logger.debug("dispatching %c (%d) to %s" %
-                         (co_type, ord(co_type), _type))
+            logger.debug("dispatching %c (%d) to %s", co_type, ord(co_type),
+                         _type)
             retval = fn(self)
         except KeyError:
             raise ValueError("invalid marshal code: %c (%d)" %
@@ -549,10 +533,20 @@ class Unmarshaller:
             n = -n
         if n > SIZE32_MAX:
             raise Exception("bad marshal data: long size out of range")
-        x = 0
-        for i in range(n):
-            d = self.r_short()
-            x = x | (d << (i*15))
+        data = self.r_string(2 * n)
+        if max(struct.unpack("<%dH" % n, data)) > 0x7fff:
+            raise Exception("bad marshal data (digit out of range in long)")
+        # the 15 bit digits sit in 16 bit lanes; squeeze out the unused bit
+        # by merging pairs of lanes into lanes twice as wide until a single
+        # one is left, which takes log2(n) bulk operations on the integer
+        x = int.from_bytes(data, "little")
+        width, bits = 16, 15
+        while n > 1:
+            n = (n + 1) // 2
+            mask = int.from_bytes((b"\xff" * (width // 8) +
+                                   bytes(width // 8)) * n, "little")
+            x = (x & mask) | (((x >> width) & mask) << bits)
+            width, bits = width * 2, bits * 2
         return x * sign
 
     def r_string(self, n):
@@ -570,19 +564,27 @@ class Unmarshaller:
         n = self.r_long()
         if n < 0 or n >= len(self.refs):
             raise Exception("bad marshal data (invalid reference: %d)" % n)
-        logger.debug("loading reference %d" % n)
+        logger.debug("loading reference %d", n)
         obj = self.refs[n]
         if obj is not None:
             return obj
         raise Exception("bad marshal data (invalid reference: %d)" % n)
 
-    @R_REF
+    def r_items(self, n):
+        # fills a preallocated list with the next n objects
+        items = [None] * n
+        for i in range(n):
+            items[i] = self.r_object()
+        return items
+
     def load_tuple(self):
         n = self.r_long()
-        l2 = []
-        for _ in range(n):
-            l2.append(self.r_object())
-        return tuple(l2.copy())
+        if n < 0 or n > SIZE32_MAX:
+            raise Exception("bad marshal data (tuple size out of range)")
+        idx = self.r_ref_reserve()
+        retval = tuple(self.r_items(n))
+        self.r_ref_insert(idx, retval)
+        return retval
 
     @R_REF
     def load_list(self):
@@ -610,6 +612,10 @@ class Unmarshaller:
         name = self.load()
         firstlineno = self.r_long()
         lnotab = self.r_object()
+        if self.code_transform is not None:
+            code = self.code_transform(code)
+        if self.consts_transform is not None:
+            consts = self.consts_transform(consts, filename, firstlineno)
         retval = types.CodeType(argcount, kwonlyargcount, nlocals, stacksize,
                                 flags, code, consts, names, varnames,
                                 filename, name, firstlineno, lnotab, freevars,
@@ -632,15 +638,15 @@ class Unmarshaller:
     def load_unknown(self):
         raise NotImplementedError
 
-    @R_REF
     def load_set(self):
         n = self.r_long()
         if n < 0 or n > SIZE32_MAX:
             raise Exception("bad marshal data (set size out of range")
-        s = set()
+        # a set is referenced before its items just like in CPython
+        s = self.r_ref(set())
         for _ in range(n):
-            s.append(self.r_object())
-        return s.copy()
+            s.add(self.r_object())
+        return s
 
     def load_frozenset(self):
         n = self.r_long()
@@ -651,11 +657,8 @@ class Unmarshaller:
         idx = self.r_ref_reserve()
         if idx < 0:
             raise Exception("bad marshal data (cannot reserve reference)")
-        l2 = []
-        for _ in range(n):
-            l2.append(self.r_object())
-        retval = frozenset(l2.copy())
-        retval = self.r_ref_insert(idx, retval)
+        retval = frozenset(self.r_items(n))
+        self.r_ref_insert(idx, retval)
         return retval
 
     @R_REF
@@ -675,11 +678,8 @@ class Unmarshaller:
 
     def load_small_tuple(self):
         n = ord(self.r_byte())
-        l2 = []
         idx = self.r_ref_reserve()
-        for _ in range(n):
-            l2.append(self.r_object())
-        retval = tuple(l2)
+        retval = tuple(self.r_items(n))
         self.r_ref_insert(idx, retval)
         return retval
 
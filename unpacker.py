@@ -1,17 +1,33 @@
 #!/usr/bin/env python3
 
 import argparse
+import contextlib
+import dis
+import fnmatch
+import json
 import logging
+import shutil
 import sys
 import struct
 import zipfile
 import io
+import marshal
+import time
 import types
 import os
+import re
 
+import fingerprint
+import hybridloader
+import membercache
+import mmapzip
 import opcodemap
+import profiler
+import registry
+import stagetrace
 import tea
 import unmarshaller
+import validate
 
 if sys.version_info[0] < 3:
     raise Exception("This module is Python 3 only")
@@ -74,36 +90,49 @@ class MT19937:
         self.index = 0
 
 
-def load_code(self):
-    rand = self.r_long()
-    length = self.r_long()
-
+def derive_key(rand, length):
     seed = rng(rand, length)
     mt = MT19937(seed)
     key = []
     for i in range(0, 4):
         key.append(mt.extract_number())
+    return key
 
-    # take care of padding for size calculation
-    sz = (length + 15) & ~0xf
-    words = sz / 4
+
+def decipher_payload(buf, key):
+    words = len(buf) // 4
 
     # convert data to list of dwords
-    buf = self._read(sz)
     data = list(struct.unpack("<%dL" % words, buf))
 
     # decrypt and convert back to stream of bytes
     data = tea.tea_decipher(data, key)
-    data = struct.pack("<%dL" % words, *data)
+    return struct.pack("<%dL" % words, *data)
+
+
+def decrypt_payload(buf, rand, length):
+    return decipher_payload(buf, derive_key(rand, length))
+
+
+def load_code(self):
+    rand = self.r_long()
+    length = self.r_long()
+
+    # take care of padding for size calculation
+    sz = (length + 15) & ~0xf
+    data = decrypt_payload(self._read(sz), rand, length)
 
     iodata = io.BytesIO(data)
     um = unmarshaller.Unmarshaller(iodata.read)
     # make sure that the rest is being marshalled with the same TYPE_CODE
-    # dispatch method as is being used for the current code object such that we
-    # end up with a consistent ummarshalled object structure (instead of for
-    # example having parent code level objects being opcode-remapped and child
-    # objects still having the obfuscated opcode-mapping.
+    # dispatch method and field transforms as are being used for the current
+    # code object such that we end up with a consistent ummarshalled object
+    # structure (instead of for example having parent code level objects
+    # being opcode-remapped and child objects still having the obfuscated
+    # opcode-mapping.
     um.opcode_mapping = self.opcode_mapping
+    um.code_transform = self.code_transform
+    um.consts_transform = self.consts_transform
     um.dispatch[unmarshaller.TYPE_CODE] = self.dispatch[unmarshaller.TYPE_CODE]
     um.flags.append(0)
     um.depth = self.depth
@@ -112,35 +141,111 @@ def load_code(self):
 
 
 def load_code_without_patching(self):
-    code = load_code(self)
-    return types.CodeType(code.co_argcount, code.co_kwonlyargcount,
-                          code.co_nlocals, code.co_stacksize, code.co_flags,
-                          code.co_code, code.co_consts, code.co_names,
-                          code.co_varnames, code.co_filename, code.co_name,
-                          code.co_firstlineno, code.co_lnotab,
-                          code.co_freevars, code.co_cellvars)
+    return load_code(self)
+
+
+def remap_code_bytes(bcode, opcode_map):
+    # opcodes sit at every even offset as of Python 3.6 wordcode so they can
+    # be remapped with a single translate(); STORE_NAME (90) is left as-is
+    table = opcode_map.translation
+    if table[90] != 90:
+        table = table[:90] + b"\x5a" + table[91:]
+    bcode = bytearray(bcode)
+    bcode[::2] = bcode[::2].translate(table)
+    return bytes(bcode)
+
+
+def code_remapper(opcode_map):
+    return lambda bcode: remap_code_bytes(bcode, opcode_map)
 
 
 def load_code_with_patching(self):
-    code = load_code(self)
-    bcode = bytearray(code.co_code)
-    opcode_map = self.opcode_mapping
-    i = 0
-    n = len(bcode)
-    while i < n:
-        old = bcode[i]
-        new = opcode_map.get(bcode[i])
-        if old != 90:
-            bcode[i] = new
-        i = i + (2)  # HAVE_ARGUMENT
-        # 144 extended_arg
-    bcode = bytes(bcode)
-    return types.CodeType(code.co_argcount, code.co_kwonlyargcount,
-                          code.co_nlocals, code.co_stacksize, code.co_flags,
-                          bcode, code.co_consts, code.co_names,
-                          code.co_varnames, code.co_filename, code.co_name,
-                          code.co_firstlineno, code.co_lnotab,
-                          code.co_freevars, code.co_cellvars)
+    # the opcodes are remapped while the code object is being loaded so that
+    # only a single CodeType gets created for it
+    if self.code_transform is None:
+        self.code_transform = code_remapper(self.opcode_mapping)
+    return load_code(self)
+
+
+def remap_code_object(co, opcode_map):
+    consts = tuple(remap_code_object(x, opcode_map)
+                   if isinstance(x, types.CodeType) else x
+                   for x in co.co_consts)
+    bcode = remap_code_bytes(co.co_code, opcode_map)
+    return types.CodeType(co.co_argcount, co.co_kwonlyargcount,
+                          co.co_nlocals, co.co_stacksize, co.co_flags,
+                          bcode, consts, co.co_names,
+                          co.co_varnames, co.co_filename, co.co_name,
+                          co.co_firstlineno, co.co_lnotab,
+                          co.co_freevars, co.co_cellvars)
+
+
+def decrypt_pyc(fn, raw, opc_map=None, trace=None):
+    # returns the pyc file with its encrypted marshal stream turned into a
+    # standard one. The encrypted code objects are decrypted in place by the
+    # hybrid loader; if an opcode mapping is given the opcodes are remapped
+    # in the stream as well, which saves rebuilding every code object later.
+    if trace is None:
+        trace = stagetrace.MemberTrace(fn)
+    start = time.perf_counter()
+    try:
+        sd = hybridloader.StreamDecrypter()
+        if opc_map is not None:
+            sd.code_transform = code_remapper(opc_map)
+        sd.w_object(memoryview(raw)[16:], 0, [])
+        data = bytes(raw[:16]) + bytes(sd.out)
+        trace.add("keyderiv", sd.key_time)
+        trace.add("decrypt", sd.decrypt_time)
+        trace.add("unmarshal", time.perf_counter() - start -
+                  sd.key_time - sd.decrypt_time)
+    except Exception as e:
+        logger.debug("hybrid loader failed on %s (%s), falling back to "
+                     "the pure Python unmarshaller" % (fn, str(e)))
+        um = unmarshaller.Unmarshaller(io.BytesIO(raw[16:]).read)
+        if opc_map is not None:
+            um.code_transform = code_remapper(opc_map)
+        um.dispatch[unmarshaller.TYPE_CODE] = (load_code, "TYPE_CODE")
+        data = bytes(raw[:16]) + marshal.dumps(um.load())
+        trace.add("unmarshal", time.perf_counter() - start)
+    return data
+
+
+def load_pyc_data(data, opc_map=None, trace=None):
+    # loads a decrypted pyc file and remaps its opcodes if a mapping is given
+    if trace is None:
+        trace = stagetrace.MemberTrace(None)
+    with trace.stage("unmarshal"):
+        co = marshal.loads(data[16:])
+    trace.code_objects = stagetrace.count_code_objects(co)
+    if opc_map is None:
+        return co
+    with trace.stage("remap"):
+        return remap_code_object(co, opc_map)
+
+
+def load_pyc(zf, fn, opc_map=None, cache=None, trace=None):
+    # load the top-level code object of a pyc member and remap its opcodes if
+    # an opcode mapping is given. With a member cache the decrypted but not
+    # yet remapped marshal stream is stored such that later runs skip the
+    # decryption altogether.
+    if trace is None:
+        trace = stagetrace.MemberTrace(fn)
+    info = zf.getinfo(fn)
+    trace.bytes_in = info.file_size
+    data = None
+    if cache is not None:
+        with trace.stage("read"):
+            data = cache.get(info)
+        trace.cached = data is not None
+    if data is None:
+        with trace.stage("read"):
+            raw = zf.read(info)
+        if cache is None:
+            return load_pyc_data(decrypt_pyc(fn, raw, opc_map, trace), None,
+                                 trace)
+        data = decrypt_pyc(fn, raw, None, trace)
+        cache.put(info, data)
+    return load_pyc_data(data, opc_map, trace)
 
 
 def decompile_co_object(co):
@@ -154,46 +259,107 @@ def decompile_co_object(co):
     return (True, out.getvalue())
 
 
-def decompile_pycfiles_from_zipfile(opc_map, zf, outdir):
-    failed = 0
-    processed = 0
-    for fn in zf.namelist():
+def disassemble_co_object(co):
+    # the code info (constants, names, variables, ...) and the disassembly
+    # with line numbers of a code object and of all the code objects nested
+    # in it, depth first
+    out = io.StringIO()
+    todo = [(co, co.co_name)]
+    while todo:
+        co, path = todo.pop()
+        out.write("%s\n\nDisassembly of %s (line %d):\n%s\n\n" %
+                  (dis.code_info(co), path, co.co_firstlineno,
+                   dis.Bytecode(co).dis()))
+        prefix = "" if co.co_name == "<module>" else path + "."
+        todo.extend(reversed([(x, prefix + x.co_name) for x in co.co_consts
+                              if isinstance(x, types.CodeType)]))
+    # without the addresses of the code objects to keep the output the same
+    # from run to run
+    return re.sub(r" at 0x[0-9a-f]+", "", out.getvalue())
+
+
+def replicate_output(srcfn, dstfn, mode):
+    # dst can be left over from an earlier run into the same output dir, and
+    # may already be a hard link to src
+    if os.path.exists(dstfn) and os.path.samefile(srcfn, dstfn):
+        return
+    if mode == "link":
+        tmpfn = dstfn + ".tmp"
+        try:
+            if os.path.lexists(tmpfn):
+                os.unlink(tmpfn)
+            os.link(srcfn, tmpfn)
+            os.replace(tmpfn, dstfn)
+            return
+        except OSError as e:
+            logger.debug("cannot hard link %s to %s (%s), copying instead" %
+                         (dstfn, srcfn, str(e)))
+    shutil.copyfile(srcfn, dstfn)
+
+
+def read_manifest(fn):
+    # (CRC, size) per member of either a zip or a manifest written by
+    # write_manifest
+    if zipfile.is_zipfile(fn):
+        with mmapzip.open_zipfile(fn) as zf:
+            return dict((x.filename, (x.CRC, x.file_size))
+                        for x in zf.infolist())
+    with open(fn, "r") as fd:
+        return dict((k, tuple(v)) for k, v in json.load(fd).items())
+
+
+def write_manifest(zf, fn, members=None):
+    # records the CRC and size of members (all if None) on top of what an
+    # earlier manifest in fn holds for the other members still in zf, such
+    # that members that were left out or failed are picked up again
+    manifest = {}
+    if members is not None and os.path.exists(fn):
+        names = set(zf.namelist())
+        manifest = dict((k, v) for k, v in read_manifest(fn).items()
+                        if k in names)
+    for x in zf.infolist():
+        if members is None or x.filename in members:
+            manifest[x.filename] = (x.CRC, x.file_size)
+    with open(fn, "w") as fd:
+        json.dump(manifest, fd, indent=1, sort_keys=True)
+
+
+def select_members(zf, include=(), exclude=(), manifest=None):
+    # the pyc files matching any of the include globs (all if there are none)
+    # and none of the exclude globs which are new or differ from the manifest;
+    # this only looks at the central directory. A * matches a / as well, so
+    # dropbox/sync/* selects everything below dropbox/sync.
+    selected = set()
+    for info in zf.infolist():
+        fn = info.filename
         if fn[-3:] != "pyc":
             continue
-        with zf.open(fn, "r") as f:
-            processed += 1
-
-            logger.info("Decrypting, patching and decompiling %s" % fn)
-            try:
-                f.read(16)
-                um = unmarshaller.Unmarshaller(f.read)
-                um.opcode_mapping = opc_map
-                um.dispatch[unmarshaller.TYPE_CODE] = (load_code_with_patching,
-                                                       "TYPE_CODE")
-                co = um.load()
-
-                outfn = os.path.join(outdir, fn[:-1])
-                ok, res = decompile_co_object(co)
-                if not ok:
-                    logger.warning("Failed to decompile %s to %s" %
-                                   (fn, outfn))
-                    failed += 1
-                else:
-                    logger.info("Successfully decompiled %s to %s" %
-                                (fn, outfn))
-
-                partial_dirname = os.path.dirname(fn)
-                full_dirname = os.path.join(outdir, partial_dirname)
-                os.makedirs(full_dirname, exist_ok=True)
-                with open(outfn, "wb") as outfd:
-                    outfd.write(res.encode("utf-8"))
-
-            except Exception as e:
-                failed += 1
-                logger.error("Exception %s occured" % str(e))
-                break
-    logger.info("Processed %d files (%d succesfully decompiled, %d failed)" %
-                (processed, processed-failed, failed))
+        if include and not any(fnmatch.fnmatchcase(fn, x) for x in include):
+            continue
+        if any(fnmatch.fnmatchcase(fn, x) for x in exclude):
+            continue
+        if manifest is not None and \
+                manifest.get(fn) == (info.CRC, info.file_size):
+            continue
+        selected.add(fn)
+    return selected
+
+
+def decompile_pycfiles_from_zipfile(opc_map, zf, outdir, cache=None,
+                                    trace=None, profile=None, dedup="copy",
+                                    stdlib=None, stdlib_action="copy", jobs=1,
+                                    read_depth=16, write_depth=16,
+                                    split_threshold=0, fallback=None,
+                                    emit="source", selected=None):
+    # returns the members that were unpacked without errors
+    # imported here as the pipeline itself uses the loaders in this module
+    import pipeline
+    p = pipeline.Pipeline(opc_map, zf, outdir, cache, trace, profile, dedup,
+                          stdlib, stdlib_action, jobs, read_depth,
+                          write_depth, split_threshold, fallback, emit,
+                          selected)
+    p.run()
+    return p.done
 
 
 if __name__ == "__main__":
@@ -201,6 +367,11 @@ if __name__ == "__main__":
     root = logging.getLogger()
     root.setLevel(logging.WARNING)
     logger.setLevel(logging.DEBUG)
+    # the unpack loop and the modules it uses log the progress and the
+    # summaries through their own loggers
+    for name in ("pipeline", "stagetrace", "validate", "membercache",
+                 "profiler", "registry", "importgraph"):
+        logging.getLogger(name).setLevel(logging.DEBUG)
     handler = logging.StreamHandler(sys.stdout)
     handler.setLevel(logging.DEBUG)
     formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
@@ -227,11 +398,188 @@ if __name__ == "__main__":
     parser.add_argument("--output-dir", default="./out",
                         help="output dir for the decompiled source code "
                              "(will be created if it doesn't exist)")
-    parser.add_argument("--db", default="opcode.db",
-                        help="opcode database file to use")
+    parser.add_argument("--db",
+                        help="opcode database file to use (selected from the "
+                             "registry by zip fingerprint if not given)")
+    parser.add_argument("--registry", default="registry",
+                        help="directory holding the opcode maps indexed by "
+                             "zip fingerprint")
+    parser.add_argument("--python-dir",
+                        help="Python source dir used for a partial gendb run "
+                             "when no registered opcode map matches the zip")
+    parser.add_argument("--gendb-limit", type=int, default=200,
+                        help="number of stdlib files mapped in the partial "
+                             "gendb run")
+    parser.add_argument("--cache",
+                        help="member cache file with decrypted marshal "
+                             "streams (created if it doesn't exist)")
+    parser.add_argument("--validate", action="store_true",
+                        help="validate the opcode map on a sample of code "
+                             "objects and refuse to run if it scores too low")
+    parser.add_argument("--validate-sample", type=int, default=64,
+                        help="number of pyc files sampled for validation")
+    parser.add_argument("--min-score", type=float, default=0.95,
+                        help="minimum validation score required to proceed")
+    parser.add_argument("--trace",
+                        help="write per-member stage timings to this file as "
+                             "JSON lines and log a summary at the end")
+    parser.add_argument("--profile", action="append", metavar="GLOB",
+                        help="profile the members matching this glob (can "
+                             "be given multiple times)")
+    parser.add_argument("--profile-slowest", type=float, metavar="PCT",
+                        help="profile every member and keep the profiles of "
+                             "the slowest PCT percent")
+    parser.add_argument("--profile-mode", default="sampling",
+                        choices=("sampling", "deterministic"),
+                        help="profiler to use")
+    parser.add_argument("--profile-interval", type=float, default=0.001,
+                        help="sampling interval in seconds")
+    parser.add_argument("--profile-dir", default="./profile",
+                        help="output dir for the collapsed stack files")
+    parser.add_argument("--dedup", default="copy",
+                        choices=("copy", "link", "none"),
+                        help="decompile identical modules only once and copy "
+                             "or hard link the output for the duplicates")
+    parser.add_argument("--stdlib-fingerprints",
+                        help="fingerprint file built by fingerprint.py; "
+                             "modules identical to the stdlib aren't "
+                             "decompiled")
+    parser.add_argument("--stdlib-action", default="copy",
+                        choices=("copy", "skip"),
+                        help="copy the original stdlib source for matching "
+                             "modules or only write a marker")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of worker processes decrypting and "
+                             "decompiling members")
+    parser.add_argument("--read-queue", type=int, default=16,
+                        help="number of members read ahead from the zip")
+    parser.add_argument("--write-queue", type=int, default=16,
+                        help="number of decompiled files queued for writing")
+    parser.add_argument("--split-threshold", type=int, default=0,
+                        help="pyc size in bytes from which on the top-level "
+                             "functions and classes of a module are "
+                             "decompiled separately (0 disables this)")
+    parser.add_argument("--emit", choices=("source", "dis"),
+                        default="source",
+                        help="decompile the modules or only write their "
+                             "remapped disassembly to .dis files")
+    parser.add_argument("--no-fallback", action="store_true",
+                        help="don't decompile the modules that fail as a "
+                             "whole function by function")
+    parser.add_argument("--fallback-budget", type=float, default=30,
+                        help="seconds after which decompiling a single "
+                             "function or class in the fallback is given up "
+                             "(0 for no limit)")
+    parser.add_argument("--include", action="append", default=[],
+                        metavar="GLOB",
+                        help="only unpack the members matching this glob "
+                             "(can be given more than once)")
+    parser.add_argument("--exclude", action="append", default=[],
+                        metavar="GLOB",
+                        help="don't unpack the members matching this glob "
+                             "(can be given more than once)")
+    parser.add_argument("--changed-since", metavar="MANIFEST",
+                        help="only unpack the members that are new or "
+                             "changed compared to this manifest or zip")
+    parser.add_argument("--write-manifest", metavar="MANIFEST",
+                        help="record the CRC and size of every member that "
+                             "was unpacked in this file (on top of what it "
+                             "already holds) for a later --changed-since")
+    parser.add_argument("--include-closure", action="append", default=[],
+                        metavar="MODULE",
+                        help="only unpack this module and the modules it "
+                             "imports, directly or indirectly (can be given "
+                             "more than once)")
+    parser.add_argument("--zip-reader", choices=("mmap", "zipfile"),
+                        default="mmap",
+                        help="read the zip through a memory mapping or with "
+                             "the zipfile module")
     ns = parser.parse_args()
-
-    with opcodemap.OpcodeMapping(ns.db, False) as opc_map:
-        with zipfile.PyZipFile(ns.dropbox_zip, "r",
-                               zipfile.ZIP_DEFLATED) as zf:
-            decompile_pycfiles_from_zipfile(opc_map, zf, ns.output_dir)
+    if ns.jobs > 1 and (ns.profile or ns.profile_slowest):
+        parser.error("--profile and --profile-slowest only work with "
+                     "--jobs 1")
+
+    if ns.zip_reader == "mmap":
+        zf = mmapzip.open_zipfile(ns.dropbox_zip)
+    else:
+        zf = zipfile.PyZipFile(ns.dropbox_zip, "r", zipfile.ZIP_DEFLATED)
+    with zf:
+        if not ns.db:
+            fp = registry.fingerprint_zipfile(zf)
+            ns.db = registry.lookup(ns.registry, fp)
+            if ns.db:
+                logger.info("using opcode map %s for fingerprint %s" %
+                            (ns.db, fp))
+            elif ns.python_dir:
+                ns.db = registry.generate_partial(ns.registry, fp, zf,
+                                                  ns.dropbox_zip,
+                                                  ns.python_dir,
+                                                  ns.gendb_limit)
+            elif registry.lookup(ns.registry, fp, True):
+                ns.db = registry.lookup(ns.registry, fp, True)
+                logger.warning("using the partial opcode map %s for "
+                               "fingerprint %s; register the map of a full "
+                               "gendb run for better results" % (ns.db, fp))
+            else:
+                logger.warning("no opcode map registered for %s and no "
+                               "--python-dir given; falling back to "
+                               "opcode.db" % fp)
+                ns.db = "opcode.db"
+
+        with contextlib.ExitStack() as stack:
+            opc_map = stack.enter_context(opcodemap.OpcodeMapping(ns.db,
+                                                                  False))
+            cache = None
+            if ns.cache:
+                cache = stack.enter_context(membercache.MemberCache(ns.cache))
+            if ns.validate:
+                score = validate.validate_opcode_mapping(opc_map, zf,
+                                                         ns.validate_sample,
+                                                         cache)
+                if score < ns.min_score:
+                    logger.fatal("opcode map %s scored %.3f which is below "
+                                 "the minimum of %.3f; not decompiling" %
+                                 (ns.db, score, ns.min_score))
+                    sys.exit(1)
+            trace = None
+            if ns.trace:
+                trace = stack.enter_context(
+                    stagetrace.PipelineTrace(ns.trace))
+            profile = None
+            if ns.profile or ns.profile_slowest:
+                profile = stack.enter_context(
+                    profiler.ProfileSession(ns.profile_dir, ns.profile,
+                                            ns.profile_slowest,
+                                            ns.profile_mode,
+                                            ns.profile_interval))
+            stdlib = None
+            if ns.stdlib_fingerprints:
+                stdlib = fingerprint.StdlibFingerprints.load(
+                    ns.stdlib_fingerprints)
+            fallback = None if ns.no_fallback else ns.fallback_budget
+            selected = None
+            if ns.include or ns.exclude or ns.changed_since:
+                manifest = None
+                if ns.changed_since:
+                    manifest = read_manifest(ns.changed_since)
+                selected = select_members(zf, ns.include, ns.exclude,
+                                          manifest)
+            if ns.include_closure:
+                # imported here as it uses the loaders in this module
+                import importgraph
+                graph = importgraph.ImportGraph.build(zf, opc_map, cache)
+                closure = graph.files(graph.closure(ns.include_closure))
+                logger.info("%d modules are loaded by importing %s" %
+                            (len(closure), ", ".join(ns.include_closure)))
+                selected = closure if selected is None else \
+                    selected & closure
+            if selected is not None:
+                logger.info("unpacking %d of the %d members" %
+                            (len(selected), len(zf.namelist())))
+            done = decompile_pycfiles_from_zipfile(
+                opc_map, zf, ns.output_dir, cache, trace, profile, ns.dedup,
+                stdlib, ns.stdlib_action, ns.jobs, ns.read_queue,
+                ns.write_queue, ns.split_threshold, fallback, ns.emit,
+                selected)
+            if ns.write_manifest:
+                write_manifest(zf, ns.write_manifest, done)
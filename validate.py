@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import dis
+import logging
+import sys
+import time
+import types
+import zipfile
+
+import membercache
+import opcodemap
+import unpacker
+
+if sys.version_info[0] < 3:
+    raise Exception("This module is Python 3 only")
+
+logger = logging.getLogger(__name__)
+
+# opcodes after which execution never falls through to the next instruction
+TERMINATORS = set(dis.opmap[x] for x in ("RETURN_VALUE", "RAISE_VARARGS",
+                                         "JUMP_ABSOLUTE", "JUMP_FORWARD",
+                                         "BREAK_LOOP", "CONTINUE_LOOP")
+                  if x in dis.opmap)
+# CONTINUE_LOOP unwinds the block stack before jumping so the depth at its
+# target cannot be derived from the depth at the jump itself
+JUMPS = (set(dis.hasjrel) | set(dis.hasjabs)) - \
+        set([dis.opmap.get("CONTINUE_LOOP")])
+
+# stack effects that differ depending on whether the jump is taken, as per
+# stack_effect() in Python-3.7.4/Python/compile.c; the first value is for the
+# fall through case and the second one for when the jump is taken
+JUMP_EFFECTS = {
+    "FOR_ITER": (1, -1),
+    "JUMP_IF_TRUE_OR_POP": (-1, 0),
+    "JUMP_IF_FALSE_OR_POP": (-1, 0),
+    "SETUP_EXCEPT": (0, 6),
+    "SETUP_FINALLY": (0, 6),
+    "SETUP_WITH": (1, 6),
+    "SETUP_ASYNC_WITH": (0, 5),
+}
+JUMP_EFFECTS = dict((dis.opmap[k], v) for k, v in JUMP_EFFECTS.items()
+                    if k in dis.opmap)
+
+
+def _stack_effects(op, arg):
+    if op == dis.EXTENDED_ARG:
+        return 0, 0
+    if op in JUMP_EFFECTS:
+        return JUMP_EFFECTS[op]
+    effect = dis.stack_effect(op, arg if op >= dis.HAVE_ARGUMENT else None)
+    return effect, effect
+
+
+def check_code_object(co):
+    # returns None if the code object passes all the structural checks or a
+    # string describing the first check that failed otherwise
+    n = len(co.co_code)
+    if n == 0 or n % 2:
+        return "invalid code length %d" % n
+
+    instrs = {}
+    try:
+        for ins in dis.get_instructions(co):
+            if ins.opname[0] == "<":
+                return "unknown opcode %d at %d" % (ins.opcode, ins.offset)
+            if ins.opcode in dis.hasjrel or ins.opcode in dis.hasjabs:
+                if not (0 <= ins.argval < n) or ins.argval % 2:
+                    return "jump target %d out of range at %d" % \
+                            (ins.argval, ins.offset)
+            instrs[ins.offset] = ins
+    except (IndexError, KeyError, ValueError):
+        # the operand of the instruction refers to a non-existing constant,
+        # name or variable
+        return "operand out of range"
+
+    # propagate the maximum stack depth at which every instruction can be
+    # reached; just like stackdepth() in compile.c a block that can be
+    # reached with different depths is only checked against the maximum
+    depths = {0: 0}
+    maxdepth = 0
+    todo = [0]
+    while todo:
+        off = todo.pop()
+        depth = depths[off]
+        ins = instrs[off]
+        try:
+            fall, jump = _stack_effects(ins.opcode, ins.arg)
+        except ValueError:
+            return "invalid stack effect for %s at %d" % (ins.opname, off)
+        succ = []
+        if ins.opcode in JUMPS:
+            succ.append((ins.argval, depth + jump))
+        if ins.opcode not in TERMINATORS:
+            succ.append((off + 2, depth + fall))
+        for target, target_depth in succ:
+            maxdepth = max(maxdepth, target_depth)
+            if maxdepth > co.co_stacksize:
+                return "stack depth exceeds co_stacksize at %d" % off
+            if target >= n:
+                return "execution falls off the end of the code"
+            if depths.get(target, -1) < target_depth:
+                depths[target] = target_depth
+                todo.append(target)
+
+    for off, depth in depths.items():
+        ins = instrs[off]
+        fall, jump = _stack_effects(ins.opcode, ins.arg)
+        if depth + min(fall, jump) < 0:
+            return "stack underflow at %d" % off
+    if maxdepth != co.co_stacksize:
+        return "stack depth %d doesn't match co_stacksize %d" % \
+                (maxdepth, co.co_stacksize)
+    return None
+
+
+def _walk(co):
+    yield co
+    for const in co.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from _walk(const)
+
+
+def validate_opcode_mapping(opc_map, zf, sample=64, cache=None):
+    start = time.time()
+    fns = [x for x in zf.namelist() if x[-3:] == "pyc"]
+    step = max(1, len(fns) // sample)
+    total = 0
+    passed = 0
+    failures = {}
+    for fn in fns[::step][:sample]:
+        try:
+            co = unpacker.load_pyc(zf, fn, opc_map, cache)
+        except Exception as e:
+            logger.warning("failed to load %s: %s" % (fn, str(e)))
+            continue
+        for c in _walk(co):
+            total += 1
+            err = check_code_object(c)
+            if err is None:
+                passed += 1
+                continue
+            logger.debug("%s:%s: %s" % (fn, c.co_name, err))
+            reason = err.split(" at ")[0]
+            failures[reason] = failures.get(reason, 0) + 1
+    score = passed / total if total else 0.0
+    logger.info("validated %d code objects from %d files in %.2fs: score "
+                "%.3f" % (total, len(fns[::step][:sample]),
+                          time.time() - start, score))
+    for reason, count in sorted(failures.items(), key=lambda x: -x[1]):
+        logger.info("  %6d x %s" % (count, reason))
+    return score
+
+
+if __name__ == "__main__":
+
+    root = logging.getLogger()
+    root.setLevel(logging.WARNING)
+    logger.setLevel(logging.DEBUG)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    root.addHandler(handler)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dropbox-zip", required=True,
+                        help="zipfile containing the dropbox obfuscated code")
+    parser.add_argument("--db", default="opcode.db",
+                        help="opcode database file to validate")
+    parser.add_argument("--sample", type=int, default=64,
+                        help="number of pyc files to sample")
+    parser.add_argument("--min-score", type=float, default=0.95,
+                        help="fraction of code objects that must pass")
+    parser.add_argument("--cache",
+                        help="member cache file with decrypted marshal "
+                             "streams (created if it doesn't exist)")
+    ns = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        opc_map = stack.enter_context(opcodemap.OpcodeMapping(ns.db, False))
+        cache = None
+        if ns.cache:
+            cache = stack.enter_context(membercache.MemberCache(ns.cache))
+        with zipfile.PyZipFile(ns.dropbox_zip, "r",
+                               zipfile.ZIP_DEFLATED) as zf:
+            score = validate_opcode_mapping(opc_map, zf, ns.sample, cache)
+    print("score: %.3f" % score)
+    sys.exit(0 if score >= ns.min_score else 1)